@@ -0,0 +1,192 @@
+'''
+Benchmark of the optimisers on the virtual machine (dlsoo/virtual_machine.py). Each optimiser
+is run on the same test problem behind the machine's settling, latency, noise, drift and beam
+losses, all in virtual time, and the report gives the evaluations made per (virtual) hour and
+the virtual time taken to first reach a target. With --target-err the objectives are sampled
+adaptively, until their standard error is within the target (or max counts samples are taken),
+as they would be with a target error set in the add objective window.
+
+NSGA-II, MOPSO and MOSA optimise every objective; RCDS is single objective, so it optimises the
+first objective only and is timed against the first component of the target.
+
+Usage:
+    $ python benchmark.py [--algorithms nsga2,mopso,mosa,rcds] [--objectives kur1,kur2]
+                          [--target=-15,-5] [--evaluations 400] [--seed 1]
+                          [--target-err 0.05] [--max-counts 20]
+'''
+from __future__ import division
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+from dlsoo import config, interactors, virtual_machine
+from dlsoo import dlsoo_mopso, dlsoo_mosa, dlsoo_nsga2, dlsoo_rcds
+
+
+# Optimisers benchmarked by default
+ALGORITHMS = ['nsga2', 'mopso', 'mosa', 'rcds']
+# Objectives, and the ARs (all objectives minimised) that count as reaching the target
+OBJECTIVES = ['kur1', 'kur2']
+TARGET = [-15., -5.]
+# Parameters of the test problem, and their bounds
+PARAMETERS = ['a', 'b', 'c']
+PARAMETER_BOUNDS = (-5., 5.)
+# Delay (s) after setting a parameter, and the samples taken of each objective, delay (s) apart
+PARAMETER_DELAY = 1.0
+MEASUREMENT_COUNTS = 3
+MEASUREMENT_DELAY = 0.5
+# Standard error each objective is sampled to, if adaptive, and the most samples taken for it
+# (None for the default)
+TARGET_ERR = None
+MAX_COUNTS = None
+# Approximate number of evaluations each optimiser is given
+EVALUATIONS = 400
+
+
+def settings(algorithm, evaluations, seed):
+    """
+    The settings dictionary of an optimiser, as its algorithm settings window would give it,
+    sized to make about the given number of evaluations
+    """
+    if algorithm == 'nsga2':
+        population = 20
+        return {'pop_size': population, 'max_gen': max(1, evaluations // population),
+                'pmut': None, 'pcross': 0.9, 'eta_m': 20., 'eta_c': 20., 'seed': seed,
+                'add_current_to_individuals': False}
+    if algorithm == 'mopso':
+        swarm = 20
+        return {'swarm_size': swarm, 'max_iter': max(1, evaluations // swarm),
+                'inertia': 0.5, 'social_param': 1.5, 'cognitive_param': 2.0,
+                'add_current_to_individuals': False}
+    if algorithm == 'mosa':
+        return {'passInTempDrop': 0.9, 'passOutTempDrop': 0.87, 'noAneals': 5,
+                'noIterations': 35, 'failDropCount': 1, 'objCallStop': evaluations,
+                'anealPlot': 1, 'add_current_to_individuals': False}
+    if algorithm == 'rcds':
+        return {'nOIterations': 10, 'tolerance': 0., 'objCallStop': evaluations,
+                'initStep': 0.3, 'numTestPoints': 10, 'searchDirections': [],
+                'add_current_to_individuals': False}
+    raise ValueError('Unknown optimiser {0}'.format(algorithm))
+
+
+OPTIMISERS = {
+    'nsga2': dlsoo_nsga2.Optimiser,
+    'mopso': dlsoo_mopso.Optimiser,
+    'mosa': dlsoo_mosa.Optimiser,
+    'rcds': dlsoo_rcds.Optimiser,
+}
+
+
+def result(pv, target_err=TARGET_ERR, max_counts=MAX_COUNTS):
+    """
+    A minimised objective, as the add objective window would set it up
+    """
+    mrr = config.MrRepresentation()
+    mrr.mr_obj = config.DlsMeasurementVar(pv, MEASUREMENT_COUNTS, MEASUREMENT_DELAY,
+                                          target_err=target_err, max_counts=max_counts)
+    mrr.mr_label = mrr.ar_label = pv
+    mrr.mr_to_ar_sign = '+'
+    mrr.inj_setting = 0
+    return mrr
+
+
+def run(algorithm, objectives, target, evaluations, seed, target_err=TARGET_ERR,
+        max_counts=MAX_COUNTS):
+    """
+    Run one optimiser on a fresh virtual machine. Returns the machine's efficiency report, its
+    evaluations per hour and the virtual time (s) to the target, or None if it was not reached.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    if algorithm == 'rcds':
+        objectives = objectives[:1]
+        target = target[:1]
+
+    param_var_groups = [[config.DlsParamVar(pv, PARAMETER_DELAY)] for pv in PARAMETERS]
+    results = [result(pv, target_err, max_counts) for pv in objectives]
+    machine = virtual_machine.virtual_machine(seed=seed)
+    interactor = interactors.virtual_machine_interactor_bulk_base(
+        param_var_groups,
+        [mrr.mr_obj for mrr in results],
+        set_relative=[False] * len(param_var_groups),
+        results=results,
+        machine=machine)
+
+    # The optimisers write their fronts and progress as they would in a run from the GUI
+    store_location = tempfile.mkdtemp(prefix='benchmark_{0}_'.format(algorithm))
+    os.makedirs(os.path.join(store_location, 'FRONTS'))
+    try:
+        optimiser = OPTIMISERS[algorithm](
+            settings_dict=settings(algorithm, evaluations, seed),
+            interactor=interactor,
+            store_location=store_location,
+            a_min_var=[PARAMETER_BOUNDS[0]] * len(param_var_groups),
+            a_max_var=[PARAMETER_BOUNDS[1]] * len(param_var_groups),
+            progress_handler=lambda *args: None)
+        optimiser.optimise()
+    finally:
+        shutil.rmtree(store_location, ignore_errors=True)
+
+    return (machine.efficiency_report(), machine.evaluations_per_hour(),
+            machine.time_to_target(target))
+
+
+def report(rows, target):
+    """
+    The benchmark as a table, one row per optimiser
+    """
+    lines = ['Target ARs {0}'.format(', '.join(str(goal) for goal in target)),
+             '{0:<8}{1:>16}{2:>22}{3:>14}'.format('', 'evals/hour', 'time to target (h)',
+                                                   'real time (s)')]
+    for algorithm, per_hour, to_target, real_time in rows:
+        lines.append('{0:<8}{1:>16.1f}{2:>22}{3:>14.1f}'.format(
+            algorithm, per_hour,
+            'not reached' if to_target is None else '{0:.2f}'.format(to_target / 3600.),
+            real_time))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the optimisers on the virtual machine')
+    parser.add_argument('--algorithms', default=','.join(ALGORITHMS),
+                        help='comma separated optimisers, of {0}'.format(', '.join(ALGORITHMS)))
+    parser.add_argument('--objectives', default=','.join(OBJECTIVES),
+                        help='comma separated objectives, any that model.true_value knows')
+    parser.add_argument('--target', default=','.join(str(goal) for goal in TARGET),
+                        help='comma separated ARs to reach, one per objective')
+    parser.add_argument('--evaluations', type=int, default=EVALUATIONS,
+                        help='approximate evaluations per optimiser')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--target-err', type=float, default=TARGET_ERR,
+                        help='sample each objective adaptively to this standard error')
+    parser.add_argument('--max-counts', type=int, default=MAX_COUNTS,
+                        help='most samples of an adaptively sampled objective')
+    args = parser.parse_args()
+
+    algorithms = [name.strip() for name in args.algorithms.split(',') if name.strip()]
+    objectives = [pv.strip() for pv in args.objectives.split(',') if pv.strip()]
+    target = [float(goal) for goal in args.target.split(',')]
+    if len(target) != len(objectives):
+        parser.error('--target needs one value per objective')
+    for algorithm in algorithms:
+        if algorithm not in OPTIMISERS:
+            parser.error('unknown optimiser {0}'.format(algorithm))
+
+    rows = []
+    for algorithm in algorithms:
+        print 'Running {0}'.format(algorithm)
+        start = time.time()
+        efficiency, per_hour, to_target = run(algorithm, objectives, target, args.evaluations,
+                                              args.seed, args.target_err, args.max_counts)
+        print '{0}: {1}'.format(algorithm, efficiency)
+        rows.append((algorithm, per_hour, to_target, time.time() - start))
+
+    print
+    print report(rows, target)
@@ -1,18 +1,130 @@
 from __future__ import division
 import math
+import os
 import numpy as np
-from cothread.catools import caget
+import cothread
+
+from pv_names import BEAM_CURRENT_PV
 
 
 # Set before use in gui.py
 NUMBER_OF_BUNCHES = None
 
+SIGMAY_PV = 'SR-DI-EMIT-01:P1:SIGMAY_MEAN'
+PMT_COUNT_PV = 'SR-DI-COUNT-01:MEAN'
+
+
+class calibration_file(object):
+    """
+    Static data loaded from a text file, reloaded only when the file is modified
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.data = None
+
+    def get(self):
+        mtime = os.path.getmtime(self.filename)
+        if mtime != self.mtime:
+            self.data = np.loadtxt(self.filename)
+            self.mtime = mtime
+        return self.data
+
+
+class derived_objective(object):
+    """
+    An objective computed from raw PVs. expression is called with the values of pvs, in order.
+    """
+
+    def __init__(self, name, pvs, expression):
+        self.name = name
+        self.pvs = [str(pv) for pv in pvs]
+        self.expression = expression
+
+    def evaluate(self, values):
+        return self.expression(*[values[pv] for pv in self.pvs])
+
+
+# All of the derived objectives, by name
+derived_objectives = {}
+
+# The derived objectives that have been evaluated so far. Every sample reads the raw PVs of all
+# of them in one caget.
+in_use = set()
+# The latest read of the raw PVs, and the objectives that have already used it. An objective
+# that asks again triggers a new read, so no objective sees the same read twice but objectives
+# sampled together share one.
+snapshot = {}
+snapshot_users = set()
+# Signalled when a read in progress finishes
+reading = None
+
+
+def raw_pvs(names):
+    """
+    The raw PVs needed by the derived objectives in names
+    """
+    return sorted(set(pv for name in names for pv in derived_objectives[name].pvs))
+
+
+def read_snapshot():
+    # Imported here as util imports this module. Reading through util gives the raw PVs the
+    # same timeouts, retries, health records, failure policy and trace recording as any other.
+    import util
+
+    global snapshot, reading
+    reading = cothread.Event(auto_reset=False)
+    try:
+        pvs = raw_pvs(in_use)
+        snapshot = dict(zip(pvs, util.abstract_caget_list(pvs)))
+        snapshot_users.clear()
+    finally:
+        finished, reading = reading, None
+        finished.Signal()
+
+
+def clear_snapshot():
+    """
+    Forget the last read of the raw PVs, which was of the machine before the parameters changed
+    """
+    snapshot.clear()
+    snapshot_users.clear()
+
+
+def evaluate(name):
+    """
+    Evaluate a derived objective from a bulk read of the raw PVs, shared with the other derived
+    objectives where possible
+    """
+    objective = derived_objectives[name]
+    in_use.add(name)
+
+    # Wait for a read started by another objective to finish
+    while reading is not None:
+        reading.Wait()
+
+    if name in snapshot_users or any(pv not in snapshot for pv in objective.pvs):
+        read_snapshot()
+
+    snapshot_users.add(name)
+    return objective.evaluate(snapshot)
+
+
+def register(name, pvs, expression):
+    """
+    Add a derived objective, which can then be used in place of a PV name
+    """
+    derived_objectives[name] = derived_objective(name, pvs, expression)
+    name_to_function_mapping[name] = lambda: evaluate(name)
+
+
+lifetime_proxy_details = calibration_file("./lifetime_proxy_details")
 
 
 def read_data():
 
-    data = np.loadtxt("./lifetime_proxy_details")
-    return data
+    return lifetime_proxy_details.get()
 
 
 
@@ -23,13 +135,11 @@ def bunch_length(I_beam):
 
 
 
-def lifetime_proxy():
+def lifetime_proxy(sy, I_beam, PMT_count):
     data = read_data()
 
     vert_beam_size = data[0]
-    sy     = caget('SR-DI-EMIT-01:P1:SIGMAY_MEAN')
-    I_beam = caget('SR-DI-DCCT-01:SIGNAL')
-    PMT_count = caget('SR-DI-COUNT-01:MEAN')+0.001
+    PMT_count = PMT_count + 0.001
     objective =  PMT_count /  PMT_ref(I_beam) * vert_beam_size / sy  # rescaled n. of losses (note it was sy / sy_ref, corrected after IPAC)
     print('LT_proxy_resc='+str(objective))
     return objective
@@ -42,4 +152,6 @@ def PMT_ref(x):  # MA 17/4/2018
     return PMT_ref
 
 
-name_to_function_mapping = {"lifetime_proxy": lifetime_proxy}
+name_to_function_mapping = {}
+
+register("lifetime_proxy", [SIGMAY_PV, BEAM_CURRENT_PV, PMT_COUNT_PV], lifetime_proxy)
@@ -2,18 +2,65 @@ import os
 
 
 class DlsParamVar:
-    def __init__(self, pv, delay):
+    # Class level defaults so that configurations pickled before these
+    # options existed can still be loaded.
+    readback_pv = None
+    tolerance = None
+    dead_band = 0.
+    timeout = None
+    cache_tolerance = None
+
+    def __init__(self, pv, delay, readback_pv=None, tolerance=None, dead_band=0.,
+                 timeout=None, cache_tolerance=None):
         self.pv = pv
         self.delay = delay
         self.initial_setting = None
+        # If a readback is given, the parameter has settled once the readback is
+        # within tolerance of the setpoint and delay is only an upper bound
+        self.readback_pv = readback_pv
+        self.tolerance = tolerance
+        # Changes no larger than this are not written to the machine
+        self.dead_band = dead_band
+        # Channel access timeout (s) for this PV, if not the default
+        self.timeout = timeout
+        # If given, points whose settings of this parameter round to the same multiple of
+        # cache_tolerance share cached results (zero only matches exactly)
+        self.cache_tolerance = cache_tolerance
 
 
 class DlsMeasurementVar:
-    def __init__(self, pv, min_counts, delay):
+    # Class level defaults so that configurations pickled before these
+    # options existed can still be loaded.
+    streaming = False
+    robust = False
+    target_err = None
+    max_counts = None
+    timeout = None
+    auto_pace = False
+    check_timestamps = True
+
+    def __init__(self, pv, min_counts, delay, streaming=False, robust=False,
+                 target_err=None, max_counts=None, timeout=None, auto_pace=False,
+                 check_timestamps=True):
         self.pv = pv
         self.min_counts = min_counts
         self.delay = delay
         self.inj_setting = None
+        # Collect samples from a camonitor subscription instead of polling
+        self.streaming = streaming
+        # Find outliers with the median and MAD rather than the mean and standard deviation
+        self.robust = robust
+        # If a target standard error is given, sampling continues past min_counts
+        # until it is reached (or max_counts samples have been taken)
+        self.target_err = target_err
+        self.max_counts = max_counts
+        # Channel access timeout (s) for this PV, if not the default
+        self.timeout = timeout
+        # Poll at the observed update rate of the PV instead of every delay seconds
+        self.auto_pace = auto_pace
+        # Reject values from before the parameters were set, and repeats of the same update, by
+        # their EPICS timestamps. Off for PVs whose timestamps cannot be trusted.
+        self.check_timestamps = check_timestamps
 
 
 class Parameters(object):
@@ -62,6 +109,9 @@ class Parameters(object):
 
         # for injection control
         self.beam_current_bounds = None
+
+        # Number of parameters the simulator's model is resized to (None for its default)
+        self.sim_dimensions = None
         self.reset()
 
     def reset(self):
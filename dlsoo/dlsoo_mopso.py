@@ -12,7 +12,7 @@ import Tkinter
 import ttk
 
 from scipy import spatial
-from dlsoo import plot
+from dlsoo import plot, util
 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 from matplotlib.figure import Figure
@@ -53,6 +53,9 @@ class Optimiser(object):
         self.pause = False                                                                 #Pause and Cancel functions during optimisation
         self.cancel = False
 
+        self.travel_weights = util.group_delays(interactor.param_var_groups)              #particles are measured in an order that keeps the machine moves small
+        self.last_position = None                                                          #last position the machine was set to
+
         self.add_current_to_individuals = settings_dict['add_current_to_individuals']      #gives user ability to set current machine status to initial point
         if self.add_current_to_individuals == True:
             self.initParams = interactor.get_ap()
@@ -99,21 +102,25 @@ class Optimiser(object):
         global completed_iteration
 
         percentage_interval = (1./self.max_iter)/self.swarm_size                      #calculate percentage update per measurement
-        results = []
-        errors = []
-        stand_div = []
+        results = [None] * len(swarm)
+        errors = [None] * len(swarm)
+        stand_div = [None] * len(swarm)
 
-        for i in range(len(swarm)):
+        positions = [particle.position_i for particle in swarm]
+        order = util.order_by_travel(positions, self.min_var, self.max_var,
+                                     start=self.last_position, weights=self.travel_weights)   #visit particles in the order that moves the machine the least
+
+        def measured(i, all_data):
+            global completed_percentage
 
-            self.interactor.set_ap(swarm[i].position_i)                               #configure machine for measurement
-            all_data = self.interactor.get_ar()                                              #perform measuremen
-            all_results = [i.mean for i in all_data]                                  #retrieve mean from measurement
-            all_errors = [i.err for i in all_data]                                    #retrieve error from measurement
-            all_std = [i.dev for i in all_data]	                                       #retrieve the std from measurement - rhs 13/07/18
+            self.last_position = swarm[i].position_i
+            all_results = [j.mean for j in all_data]                                  #retrieve mean from measurement
+            all_errors = [j.err for j in all_data]                                    #retrieve error from measurement
+            all_std = [j.dev for j in all_data]	                                       #retrieve the std from measurement - rhs 13/07/18
 
-            results.append(all_results)
-            errors.append(all_errors)
-            stand_div.append(all_std)                                                       #rhs 13/07/18
+            results[i] = all_results                                                  #store results in swarm order
+            errors[i] = all_errors
+            stand_div[i] = all_std                                                          #rhs 13/07/18
             #if std == errors:
             #print "std = err!"
             completed_percentage += percentage_interval                               #update percentage bar on progress plot
@@ -124,8 +131,9 @@ class Optimiser(object):
             while self.pause:                                                         #keep update bar if algorithm paused
                 self.progress_handler(completed_percentage, completed_iteration)
 
-            if self.cancel:
-                break
+            return self.cancel                                                        #stop measuring if cancelled
+
+        self.interactor.evaluate_many(positions, order=order, callback=measured)      #measure the swarm
 
 
         return results, errors, stand_div
@@ -119,10 +119,8 @@ class Optimiser(object):
         '''
         Allows the algorithm to obtain the objectives from what the current parameters are.
         '''
-        #first we must set the machine to the desired parameter values
-        self.interactor.set_ap(self.param)
-        #now ask for a measurement
-        measure = self.interactor.get_ar()
+        #set the machine to the desired parameter values and measure (or use the cached measurement)
+        measure = self.interactor.evaluate(self.param)
         #now extract the mean measurment values. The above function returns the measurment as a list of objects that are instances of the
         #the measurment class in dls_optimiser_util
         f = [i.mean for i in measure]
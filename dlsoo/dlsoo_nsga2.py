@@ -5,15 +5,19 @@ Version 3
 2016-08-01 15:00
 
 '''
+import bisect
+import collections
 import random
 import os
 import sys
 import time
 
+import numpy as np
+
 import Tkinter
 import ttk
 
-from dlsoo import plot
+from dlsoo import plot, util
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 from matplotlib.figure import Figure
 
@@ -25,40 +29,203 @@ completed_generation = None
 ansi_red = "\x1B[31m"
 ansi_normal = "\x1B[0m"
 
-# cache of solutions
-memo = {}
-
-
-class solution(tuple):
-    pass
-
-
-def crowded_comparison_key(x):
-    # prefer low rank, then large distance (less crowded)
-    print x
-    return (x.rank, -x.distance)
-
-
-def remove_prop_duplicates(initial_list):
-    new_list = []
-    new_list_see = []
-
-
-    for i in initial_list:
-        i_see = i.x
-
-        if i_see not in new_list_see:
-            new_list.append(i)
-            new_list_see.append(i_see)
-
-    return new_list
+# most solutions remembered by the memo, the least recently used are forgotten first
+MEMO_SIZE = 10000
+
+
+class population(object):
+    """
+    A population held as arrays with a row per individual: the parameters X, the objectives F
+    and their uncertainties unc and deviations dev (NaN where unknown), and once sorted the
+    rank and crowding distance of every individual
+    """
+
+    def __init__(self, X, F, unc, dev):
+        self.X = X
+        self.F = F
+        self.unc = unc
+        self.dev = dev
+        self.rank = np.zeros(len(X), dtype=int)
+        self.distance = np.zeros(len(X))
+
+    def __len__(self):
+        return len(self.X)
+
+    def take(self, indices):
+        "the individuals at indices, keeping their ranks and distances"
+        p = population(self.X[indices], self.F[indices], self.unc[indices], self.dev[indices])
+        p.rank = self.rank[indices]
+        p.distance = self.distance[indices]
+        return p
+
+    def concatenate(self, other):
+        return population(np.vstack((self.X, other.X)), np.vstack((self.F, other.F)),
+                          np.vstack((self.unc, other.unc)), np.vstack((self.dev, other.dev)))
+
+
+def measurement_rows(ys, objectives):
+    "the means, errors and deviations of lists of measurements as arrays, NaN for None"
+    def rows(attribute):
+        values = [[getattr(i, attribute) for i in y] for y in ys]
+        values = [[np.nan if v is None else v for v in row] for row in values]
+        return np.array(values, dtype=float).reshape(len(ys), objectives)
+    return rows('mean'), rows('err'), rows('dev')
+
+
+def optional_values(row):
+    "a row of an array as a tuple, with None in place of NaN"
+    return tuple(None if np.isnan(v) else v for v in row.tolist())
+
+
+def unique_rows(X):
+    "the index of the first occurrence of every distinct row of X, in order"
+    seen = set()
+    keep = []
+    for i, row in enumerate(X):
+        key = row.tobytes()
+        if key not in seen:
+            seen.add(key)
+            keep.append(i)
+    return np.array(keep, dtype=int)
+
+
+class lru_memo(object):
+    """
+    Results of individuals already measured, keyed on their parameters. At most size results
+    are kept, forgetting the least recently used.
+    """
+
+    def __init__(self, size=MEMO_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, x):
+        y = self.entries.pop(x, None)
+        if y is None:
+            self.misses += 1
+            return None
+        # move to the most recently used end
+        self.entries[x] = y
+        self.hits += 1
+        return y
+
+    def add(self, x, y):
+        self.entries.pop(x, None)
+        self.entries[x] = y
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
+
+    def report(self):
+        return "{0} hits in {1} lookups ({2:.0%}), {3} of {4} results held".format(
+            self.hits, self.hits + self.misses, self.hit_rate(), len(self.entries), self.size)
+
+
+def dominance_matrix(F):
+    "D[i, j] is True if row i of F weakly dominates row j (Optimiser.dom)"
+    n = len(F)
+    weakly_better = np.ones((n, n), dtype=bool)
+    equal = np.ones((n, n), dtype=bool)
+    for m in range(F.shape[1]):
+        column = F[:, m]
+        weakly_better &= column[:, np.newaxis] <= column[np.newaxis, :]
+        equal &= column[:, np.newaxis] == column[np.newaxis, :]
+    return weakly_better & ~equal
+
+
+def two_objective_ranks(F):
+    """
+    Non-dominated ranks of points with two objectives, in O(N log N). Visited in order of the
+    first objective then the second, a point can only be dominated by points already visited,
+    and the least second objective seen in each front increases with the rank, so the rank of a
+    point is found by bisection.
+    """
+    ranks = np.zeros(len(F), dtype=int)
+    front_minima = []
+    previous = None
+    for i in np.lexsort((F[:, 1], F[:, 0])):
+        point = (F[i, 0], F[i, 1])
+        if point == previous:
+            # identical points do not dominate each other
+            ranks[i] = rank
+            continue
+        rank = bisect.bisect_right(front_minima, point[1])
+        if rank == len(front_minima):
+            front_minima.append(point[1])
+        else:
+            front_minima[rank] = point[1]
+        ranks[i] = rank
+        previous = point
+    return ranks
+
+
+def non_dominated_ranks(F):
+    """
+    The non-dominated front (0 being the best) of every row of the objective matrix F, by Deb's
+    fast non-dominated sort over a dominance matrix
+    """
+    F = np.asarray(F, dtype=float).reshape(len(F), -1)
+    # NaN compares as neither better nor worse, which bisection cannot handle
+    if F.shape[1] == 2 and not np.isnan(F).any():
+        return two_objective_ranks(F)
+
+    dominates = dominance_matrix(F)
+    domination_count = dominates.sum(axis=0)
+    ranks = np.empty(len(F), dtype=int)
+    ranks.fill(-1)
+
+    rank = 0
+    front = np.flatnonzero(domination_count == 0)
+    while front.size:
+        ranks[front] = rank
+        domination_count -= dominates[front].sum(axis=0)
+        front = np.flatnonzero((domination_count == 0) & (ranks < 0))
+        rank += 1
+    return ranks
+
+
+def insert_rank(F, ranks):
+    """
+    The non-dominated ranks of a population after adding the last row of F to it, the other
+    rows having the given ranks. Only the new point and the points it dominates can change
+    front, each by one (the efficient non-dominated level update of Li et al.).
+    """
+    f = F[-1]
+    G = F[:-1]
+    dominated_by_new = np.all(f <= G, axis=1) & np.any(f != G, axis=1)
+    dominates_new = np.all(G <= f, axis=1) & np.any(G != f, axis=1)
+    rank = ranks[dominates_new].max() + 1 if dominates_new.any() else 0
+
+    ranks = ranks.copy()
+    # the points of the new point's front that it dominates move down a front, and push down
+    # the points they dominate in the next front, and so on
+    moving = np.flatnonzero(dominated_by_new & (ranks == rank))
+    level = rank
+    while moving.size:
+        following = np.flatnonzero(ranks == level + 1)
+        pushed = np.zeros(len(following), dtype=bool)
+        for i in moving:
+            pushed |= (np.all(G[i] <= G[following], axis=1) &
+                       np.any(G[i] != G[following], axis=1))
+        ranks[moving] += 1
+        moving = following[pushed]
+        level += 1
+
+    return np.append(ranks, rank)
 
 
 class Optimiser(object):
 
     def __init__(self, settings_dict, interactor, store_location, a_min_var, a_max_var, individuals=None, progress_handler=None):
 
-        self.memo = {}
+        self.memo = lru_memo()
+        # individuals that appeared more than once in one population, so were measured once
+        self.repeats = 0
 
         self.interactor = interactor
         self.store_location = store_location
@@ -68,6 +235,8 @@ class Optimiser(object):
         self.result_count = len(interactor.measurement_vars)
         self.min_var = a_min_var
         self.max_var = a_max_var
+        self.lower = np.array(a_min_var, dtype=float)
+        self.upper = np.array(a_max_var, dtype=float)
         self.pcross = settings_dict['pcross']
         self.eta_m = settings_dict['eta_m']
         self.eta_c = settings_dict['eta_c']
@@ -97,9 +266,19 @@ class Optimiser(object):
 
         self.seed = settings_dict['seed']
         self.add_current_to_individuals = settings_dict['add_current_to_individuals']
+        # breed each offspring from the population updated with the last one measured, rather
+        # than a generation at a time
+        self.steady_state = settings_dict.get('steady_state', False)
 
         self.pause = False
 
+        # the generator the variation operators draw from, seeded in optimise
+        self.random = np.random.RandomState()
+
+        # candidates are measured in an order that keeps the machine moves small
+        self.travel_weights = util.group_delays(interactor.param_var_groups)
+        self.last_ap = None
+
         print "interactor.param_var_groups: {0}".format(interactor.param_var_groups)
         print "interactor.measurement_vars: {0}".format(interactor.measurement_vars)
 
@@ -121,7 +300,10 @@ class Optimiser(object):
         file_return += "p_mut: {0}\n".format(self.pmut)
         file_return += "p_cross: {0}\n".format(self.pcross)
         file_return += "eta_m: {0}\n".format(self.eta_m)
-        file_return += "eta_c: {0}\n\n".format(self.eta_c)
+        file_return += "eta_c: {0}\n".format(self.eta_c)
+        file_return += "Steady state: {0}\n\n".format(self.steady_state)
+
+        file_return += "Memo: {0}, {1} repeats within a population\n".format(self.memo.report(), self.repeats)
 
         file_return += "Seed: {0}\n".format(self.seed)
         file_return += "Individuals: {0}".format(self.individuals)
@@ -129,13 +311,6 @@ class Optimiser(object):
         return file_return
 
 
-    def make_solution(self, x, y):
-        p = solution([i.mean for i in y])
-        p.x = x
-        p.unc = [i.err for i in y]
-        p.dev = [i.dev for i in y]
-        return p #p return now includes the standard deviation error in the solution
-
     def dom(self, a, b):
         "a weakly dominates b"
         # An individule which is the same in all respects
@@ -157,256 +332,184 @@ class Optimiser(object):
                     print "front violation!", p0, p1
                     sys.exit(1)
 
-    def find_nondominated_front(self, P):
-        # front is empty
-        front = []
-        for p0 in P:
-            # add p0 to front temporarily
-            front.append(p0)
-            for p1 in P:
-                if self.dom(p1, p0):
-                    # it's dominated, take it off the front
-                    front.pop()
-                    # p0 has been rejected, no need to keep looking
-                    break
-        # check here
-        # test_front(front)
-        return front
-
     def fast_non_dominated_sort(self, P):
-        Fs = []
-        P = set(P)
-        i = 0
-        while len(P) > 0:
-            F = self.find_nondominated_front(list(P))
-            P = P - set(F)
-            # assign non-dominated rank
-            for f in F:
-                f.rank = i
-            Fs.append(F)
-            i += 1
-        return Fs
-
-    def crowding_distance_assignment(self, front):
-        l = len(front)
-        for f in front:
-            f.distance = 0
-        # sort by each objective in turn
-        for m in range(len(front[0])):
-            s = sorted(front, key = lambda x: x[m])
-            s[0].distance = float('inf')
-            s[-1].distance = float('inf')
-            for i in range(1, l-1):
-                s[i].distance = s[i].distance + s[i + 1][m] - s[i - 1][m]
-    '''
-    def crowded_comparison_key(self, x):
-        # prefer low rank, then large distance (less crowded)
-        return (x.rank, -x.distance)
-    '''
-    def binary_tournament_selection(self, pop):
-        # already sorted by fitness
-        idx = range(len(pop))
-        p1 = random.choice(idx)
-        p2 = random.choice(idx)
-        return pop[min(p1, p2)]
-
-    def selection(self, pop):
-        return [self.binary_tournament_selection(pop) for n in range(len(pop))]
-
-    def polynomial_mutation(self, p):
-        pmut_real = self.pmut
+        "assign the non-dominated rank of every individual, returning the fronts in rank order"
+        if not len(P):
+            return []
+        P.rank = non_dominated_ranks(P.F)
+        return [np.flatnonzero(P.rank == rank) for rank in range(P.rank.max() + 1)]
+
+    def crowding_distance_assignment(self, P):
+        "the crowding distance of every individual within its front"
+        n, objectives = P.F.shape
+        P.distance = np.zeros(n)
+        if not n:
+            return
+        # sort by each objective in turn, within each front
+        for m in range(objectives):
+            order = np.lexsort((P.F[:, m], P.rank))
+            ranks = P.rank[order]
+            values = P.F[order, m]
+            # the ends of each front are always kept
+            ends = np.ones(n, dtype=bool)
+            ends[1:-1] = (ranks[1:-1] != ranks[:-2]) | (ranks[1:-1] != ranks[2:])
+            gaps = np.zeros(n)
+            gaps[1:-1] = values[2:] - values[:-2]
+            P.distance[order[~ends]] += gaps[~ends]
+            P.distance[order[ends]] = float('inf')
+
+    def sort_population(self, P):
+        "sort the population first by rank (which front) then by sparsity"
+        self.fast_non_dominated_sort(P)
+        self.crowding_distance_assignment(P)
+        return P.take(np.lexsort((-P.distance, P.rank)))
+
+    def tournament(self, P, count):
+        "the parameters of the winners of count binary tournaments, P being sorted by fitness"
+        n = len(P)
+        winners = np.minimum(self.random.randint(n, size=count), self.random.randint(n, size=count))
+        return P.X[winners]
+
+    def selection(self, P):
+        return self.tournament(P, len(P))
+
+    def polynomial_mutation(self, X):
+        "mutate every variable of every row of X with probability pmut"
         eta_m = self.eta_m
-        min_realvar = self.min_var
-        max_realvar = self.max_var
-        N = len(p)
-        q = p[:]
-        for n in range(N):
-            if random.random() > pmut_real:
-                continue
-            y = p[n]
-            yl = min_realvar[n]
-            yu = max_realvar[n]
-            delta1 = (y-yl)/(yu-yl)
-            delta2 = (yu-y)/(yu-yl)
-            rnd = random.random()
-            mut_pow = 1.0/(eta_m+1.0)
-            if rnd <= 0.5:
-                xy = 1.0-delta1
-                val = 2.0*rnd+(1.0-2.0*rnd)*(pow(xy,(eta_m+1.0)))
-                deltaq = pow(val,mut_pow) - 1.0
-            else:
-                xy = 1.0-delta2
-                val = 2.0*(1.0-rnd)+2.0*(rnd-0.5)*(pow(xy,(eta_m+1.0)))
-                deltaq = 1.0 - (pow(val,mut_pow))
-            y = y + deltaq*(yu-yl)
-            if y<yl:
-                y = yl
-            if y>yu:
-                y = yu
-            q[n] = y
-        return q
-
-    def crossover(self, pop):
-        Q = []
-        for n in range(len(pop)/2):
-            #print n
-            (c1, c2) = self.sbx20(pop[n], pop[n+1])
-            Q.append(c1)
-            Q.append(c2)
+        yl = self.lower
+        yu = self.upper
+        span = yu - yl
+        mutated = (self.random.random_sample(X.shape) <= self.pmut) & (span > 0)
+        span = np.where(span > 0, span, 1.0)
+        delta1 = (X - yl) / span
+        delta2 = (yu - X) / span
+        rnd = self.random.random_sample(X.shape)
+        mut_pow = 1.0 / (eta_m + 1.0)
+        with np.errstate(all='ignore'):
+            below = (2.0*rnd + (1.0 - 2.0*rnd) * (1.0 - delta1) ** (eta_m + 1.0)) ** mut_pow - 1.0
+            above = 1.0 - (2.0*(1.0 - rnd) + 2.0*(rnd - 0.5) * (1.0 - delta2) ** (eta_m + 1.0)) ** mut_pow
+        deltaq = np.where(rnd <= 0.5, below, above)
+        return np.where(mutated, np.clip(X + deltaq*span, yl, yu), X)
+
+    def crossover(self, X):
+        "cross the parents in pairs, each pair giving two children"
+        pairs = len(X) // 2
+        children1, children2 = self.sbx20(X[0:2*pairs:2], X[1:2*pairs:2])
+        Q = np.empty((2*pairs, X.shape[1]))
+        Q[0::2] = children1
+        Q[1::2] = children2
         return Q
 
-    def sbx20(self, p1, p2):
-        pcross_real = self.pcross
+    def sbx20(self, P1, P2):
+        "simulated binary crossover of every row of P1 with the same row of P2"
         eta_c = self.eta_c
-        min_realvar = self.min_var
-        max_realvar = self.max_var
-        # copy parents
-        child1 = p1[:]
-        child2 = p2[:]
-        # crossover?
-        if random.random() > pcross_real:
-            return (child1, child2)
+        yl = self.lower
+        yu = self.upper
         # floating point epsilon
         EPS = 2 ** -52
-        # number of variables
-        N = len(child1)
-        #print "N:{0}".format(N)
-        #print "child1: {0}".format(child1)
-        for n in range(N):
-            # 50% chance of crossing this variable
-            if random.random() > 0.5:
-                continue
-            # identical to machine precision, no crossover
-            if abs(p1[n] - p2[n]) < EPS:
-                continue
-            y1 = min(p1[n], p2[n])
-            y2 = max(p1[n], p2[n])
-            yl = min_realvar[n]
-            yu = max_realvar[n]
-            rand = random.random()
-            beta = 1.0 + (2.0*(y1-yl)/(y2-y1))
-            alpha = 2.0 - pow(beta,-(eta_c+1.0))
-            if rand <= 1.0/alpha:
-                betaq = pow ((rand*alpha),(1.0/(eta_c+1.0)))
-            else:
-                betaq = pow ((1.0/(2.0 - rand*alpha)),(1.0/(eta_c+1.0)))
-            c1 = 0.5*((y1+y2)-betaq*(y2-y1))
-            beta = 1.0 + (2.0*(yu-y2)/(y2-y1))
-            alpha = 2.0 - pow(beta,-(eta_c+1.0))
-            if rand <= 1.0/alpha:
-                betaq = pow ((rand*alpha),(1.0/(eta_c+1.0)))
-            else:
-                betaq = pow ((1.0/(2.0 - rand*alpha)),(1.0/(eta_c+1.0)))
-            c2 = 0.5*((y1+y2)+betaq*(y2-y1))
-            # bounds
-            if c1<yl:
-                c1=yl
-            if c2<yl:
-                c2=yl
-            if c1>yu:
-                c1=yu
-            if c2>yu:
-                c2=yu
-            if random.random() > 0.5:
-                child1[n] = c2
-                child2[n] = c1
-            else:
-                child1[n] = c1
-                child2[n] = c2
+        # pairs cross with probability pcross, and then each variable with probability 0.5,
+        # unless the parents are identical in it to machine precision
+        crossing = self.random.random_sample(len(P1)) <= self.pcross
+        crossed = (crossing[:, np.newaxis] & (self.random.random_sample(P1.shape) <= 0.5) &
+                   (np.abs(P1 - P2) >= EPS))
+        y1 = np.minimum(P1, P2)
+        y2 = np.maximum(P1, P2)
+        spread = np.where(crossed, y2 - y1, 1.0)
+        rand = self.random.random_sample(P1.shape)
+
+        def betaq(beta):
+            alpha = 2.0 - beta ** -(eta_c + 1.0)
+            return np.where(rand <= 1.0 / alpha, (rand * alpha) ** (1.0 / (eta_c + 1.0)),
+                            (1.0 / (2.0 - rand * alpha)) ** (1.0 / (eta_c + 1.0)))
+
+        with np.errstate(all='ignore'):
+            c1 = 0.5 * ((y1 + y2) - betaq(1.0 + 2.0 * (y1 - yl) / spread) * spread)
+            c2 = 0.5 * ((y1 + y2) + betaq(1.0 + 2.0 * (yu - y2) / spread) * spread)
+        # bounds
+        c1 = np.clip(c1, yl, yu)
+        c2 = np.clip(c2, yl, yu)
+
+        swap = self.random.random_sample(P1.shape) > 0.5
+        child1 = np.where(crossed, np.where(swap, c2, c1), P1)
+        child2 = np.where(crossed, np.where(swap, c1, c2), P2)
         return (child1, child2)
 
-    def mutation(self, pop):
-        return [self.polynomial_mutation(p) for p in pop]
+    def mutation(self, X):
+        return self.polynomial_mutation(X)
 
     def memo_lookup(self, pop):
-        done = []
+        "split the population into the results already known and the distinct points to measure"
+        done = {}
         todo = []
+        seen = set()
         for p in pop:
             p = tuple(p)
-            if p in self.memo:
-                done.append((self.make_solution(p, self.memo[p])))
-            else:
+            if p in seen:
+                self.repeats += 1
+                continue
+            seen.add(p)
+            y = self.memo.get(p)
+            if y is None:
                 todo.append(p)
+            else:
+                done[p] = y
         return (done, todo)
 
-    def evaluate(self, pop):
-        "evaluate population"
-        # now add memoization
-        result = []
+    def evaluate(self, X):
+        "evaluate the rows of X as a population"
+        xs = [tuple(x) for x in X.tolist()]
 
         # get any cached results
         # (randomly some members don't get mutated or crossed over)
-        (already_done, todo) = self.memo_lookup(pop)
+        (done, todo) = self.memo_lookup(xs)
 
-        # calculate new points
-        ys = self.evaluate_link(pop)
-        #print "ys: {0}".format(ys)
+        # only measure the new points
+        ys = self.evaluate_link([list(x) for x in todo])
 
-        # store results in cache
+        # store results in cache, unless the measurement failed so should be tried again
         for (x, y) in zip(todo, ys):
-            self.memo[x] = y
-            result.append(self.make_solution(x, y))
+            if not any(i.failed for i in y):
+                self.memo.add(x, y)
+            done[x] = y
 
-        result = result + already_done
-        print "this is the return of eval", result
-        return result
-
-    def evaluate_link(self, population):
-        data = []
+        print "memo: {0}".format(self.memo.report())
 
-        for in_pop in range(len(population)):
-            # Configure machine for the measurement
-            self.interactor.set_ap(population[in_pop])
+        X = np.array(xs, dtype=float).reshape(len(xs), self.param_count)
+        F, unc, dev = measurement_rows([done[x] for x in xs], self.result_count)
+        return population(X, F, unc, dev)
 
-            #data.append(self.interactor.get_ar())
+    def evaluate_link(self, population):
+        # Visit the candidates in the order that moves the machine the least,
+        # the results are still returned in population order
+        order = util.order_by_travel(population, self.min_var, self.max_var,
+                                     start=self.last_ap, weights=self.travel_weights)
 
-            all_data = self.interactor.get_ar()
-            #print "all_data: {0}".format(all_data)
-            #print "population[in_pop]: {0}".format(population[in_pop])
-            #print "hi mom!"
-            #print ["get_ar() stds: {0}".format(i.dev) for i in all_data]
-            #all_data = [i.mean for i in all_data] # Pull out just the means from the returned data
-            data.append(all_data)
+        data = self.interactor.evaluate_many(population, order=order)
+        if order:
+            self.last_ap = population[order[-1]]
 
-        #return [i[0] for i in data]
         return data
 
-    def make_new_pop(self, pop):
+    def make_new_pop(self, P):
 
         # only need inputs at this stage
         # (we are already sorted by fitness)
-        pop = [list(p.x) for p in pop]
-
-        pop = self.selection(pop)
-        pop = self.crossover(pop)
-        pop = self.mutation(pop)
+        X = self.selection(P)
+        X = self.crossover(X)
+        X = self.mutation(X)
 
         # now evaluate the new populuation members
-        pop = self.evaluate(pop)
-
-        return pop
+        return self.evaluate(X)
 
     def random_population(self):
         "produce a random population within bounds"
-        S = self.population_size
-        min_realvar = self.min_var
-        max_realvar = self.max_var
-        N = len(min_realvar)
-        X0 = []
-        for s in range(S):
-            x = [0] * N
-            for n in range(N):
-                lb = min_realvar[n]
-                ub = max_realvar[n]
-                x[n] = lb + (random.random()) * (ub - lb)
-            X0.append(x)
-        return X0
-
-    def set_population_from_individules(self, pop):
-        individules = self.individuals
-        for i, individule in enumerate(individules):
-            pop[i] = individule
-        return pop
+        shape = (self.population_size, self.param_count)
+        return self.lower + self.random.random_sample(shape) * (self.upper - self.lower)
+
+    def set_population_from_individules(self, X):
+        for i, individule in enumerate(self.individuals):
+            X[i] = individule
+        return X
     '''
     def load_input(self, filename):
         options = {}
@@ -469,17 +572,15 @@ class Optimiser(object):
 
         return options
     '''
-    def dump_fronts(self, fronts, generation):
+    def dump_fronts(self, P, generation):
 
         f = file("{0}/FRONTS/fronts.{1}".format(self.store_location, generation), "w")
         f.write("fronts = (\n")
-        for i, front in enumerate(fronts):
+        for i in range(P.rank.max() + 1 if len(P) else 0):
             f.write("( # Front %d\n" % i)
-            for ff in front:
-
-                #f.write("    (%s, %s),\n" % (ff.x[:], ff[:]))
-                f.write("    (%s, %s, %s, %s),\n" % (ff.x[:], ff[:], tuple(ff.unc[:]), tuple(ff.dev)))
-                print "\n\n\n!!!\n{0}\n!!!\n\n\n".format(ff.unc[:])
+            for j in np.flatnonzero(P.rank == i):
+                f.write("    (%s, %s, %s, %s),\n" % (tuple(P.X[j].tolist()), tuple(P.F[j].tolist()),
+                                                    optional_values(P.unc[j]), optional_values(P.dev[j])))
             f.write("),\n")
         f.write(")\n")
         f.close()
@@ -511,46 +612,44 @@ class Optimiser(object):
             self.individuals = list(self.individuals)
             self.individuals[0] = current_ap
 
-        # seed the random number generator to ensure repeatble results
+        # seed the random number generator to ensure repeatble results, the variation
+        # operators drawing from a numpy generator seeded from it
         random.seed(self.seed)
+        self.random = np.random.RandomState(random.randint(0, 2 ** 32 - 1))
 
         # initialize population
         X0 = self.random_population()
         X0 = self.set_population_from_individules(X0)
         P = self.evaluate(X0)
-        Q = []
+        Q = None
         print "X0: {0}".format(X0)
-        print "P: {0}".format(P)
+
+        if self.steady_state:
+            self.optimise_steady_state(P)
+            print "DONE"
+            return
 
         # for each generation
         for t in range(self.generations):
 
             # combine parent and child populations
-            R = P + Q
-
+            R = P.concatenate(Q) if Q is not None else P
 
             # remove duplicates
-            #R = list(set(R))
-            R = remove_prop_duplicates(R)
+            R = R.take(unique_rows(R.X))
 
-            # find all non-dominated fronts
-            fronts = self.fast_non_dominated_sort(R)
-
-            # calculate the density of solutions around each point
-            for f in fronts:
-                self.crowding_distance_assignment(f)
-
-            # sort first by rank (which front) then by sparsity
-            R.sort(key = crowded_comparison_key)
+            # find all non-dominated fronts, and the density of solutions around each point,
+            # and sort by them
+            R = self.sort_population(R)
 
             # take the best solutions that fit in our population size
-            P = R[:self.population_size]
+            P = R.take(np.arange(min(len(R), self.population_size)))
 
             # tournament, crossover, mutation
             Q = self.make_new_pop(P)
 
             # print out all solutions by front
-            self.dump_fronts(fronts, t)
+            self.dump_fronts(R, t)
 
             # Signal progress
             print "generation %d" % t
@@ -563,6 +662,57 @@ class Optimiser(object):
         #self.progress_handler(t+1)
 
 
+    def optimise_steady_state(self, P):
+        """
+        Steady state main loop: each offspring is inserted into the population as soon as it
+        has been measured, the worst individual is removed, and the next offspring is bred from
+        the updated population. The same number of individuals are measured as in the
+        generational loop, and the fronts are written, and progress signalled, once every
+        population_size offspring, so that generations count as they do in that loop.
+        """
+        global completed_generation
+
+        P = self.sort_population(P)
+        steps = self.generations * self.population_size
+        for t in range(steps):
+
+            # tournament, crossover, mutation of a single offspring
+            parents = self.tournament(P, 2)
+            children = self.sbx20(parents[:1], parents[1:])
+            child = self.mutation(children[self.random.randint(2)])
+            offspring = self.evaluate(child)
+
+            # an offspring that is already in the population changes nothing
+            if not np.all(P.X == offspring.X[0], axis=1).any():
+                R = P.concatenate(offspring)
+                R.rank = insert_rank(R.F, P.rank)
+                self.crowding_distance_assignment(R)
+
+                # remove the most crowded of the worst front, which leaves the other ranks as
+                # they are
+                if len(R) > self.population_size:
+                    last = np.flatnonzero(R.rank == R.rank.max())
+                    worst = last[np.argmin(R.distance[last])]
+                    R = R.take(np.delete(np.arange(len(R)), worst))
+                    self.crowding_distance_assignment(R)
+
+                P = R.take(np.lexsort((-R.distance, R.rank)))
+
+            if (t + 1) % self.population_size:
+                continue
+            generation = t // self.population_size
+
+            # print out all solutions by front
+            self.dump_fronts(P, generation)
+
+            # Signal progress
+            print "generation %d" % generation
+            completed_generation = generation
+            self.progress_handler(float(generation) / float(self.generations), generation)
+            while self.pause:
+                self.progress_handler(float(generation) / float(self.generations), generation)
+
+
 class import_algo_frame(Tkinter.Frame):
 
     def __init__(self, parent):
@@ -608,7 +758,12 @@ class import_algo_frame(Tkinter.Frame):
         self.i6.insert(0, time.time())
 
 
-        Tkinter.Label(self, text="Recommended:\nMutation probability: 0.1 / (number of parameters)\nCrossover probability: 0.9\nEta_m: 20\nEta_c: 20\nSeed: Any int or float (default is seconds since system epoch)", justify=Tkinter.LEFT).grid(row=7, column=0, columnspan=2, sticky=Tkinter.W)
+        self.steady_state = Tkinter.BooleanVar(self)
+        self.steady_state.set(False)
+        self.c0 = Tkinter.Checkbutton(self, text="Steady state (breed from each new measurement)", variable=self.steady_state)
+        self.c0.grid(row=7, column=0, columnspan=2, sticky=Tkinter.W)
+
+        Tkinter.Label(self, text="Recommended:\nMutation probability: 0.1 / (number of parameters)\nCrossover probability: 0.9\nEta_m: 20\nEta_c: 20\nSeed: Any int or float (default is seconds since system epoch)", justify=Tkinter.LEFT).grid(row=8, column=0, columnspan=2, sticky=Tkinter.W)
 
         self.i0.insert(0, "10")
         self.i1.insert(0, "10")
@@ -660,6 +815,8 @@ class import_algo_frame(Tkinter.Frame):
         elif self.add_current_to_individuals.get() == 1:
             setup['add_current_to_individuals'] = True
 
+        setup['steady_state'] = bool(self.steady_state.get())
+
         return setup
 
 
@@ -125,10 +125,8 @@ class Optimiser(object):
         Allows the agorithm to evaluate the objective.
         '''
         params = self.getParams()
-        #first we must set the machine to the desired parameter values
-        self.interactor.set_ap(params)
-        #now ask for a measurement
-        measure = self.interactor.get_ar()
+        #set the machine to the desired parameter values and measure (or use the cached measurement)
+        measure = self.interactor.evaluate(params)
         self.numFuncEval += 1
         #now extract the mean measurment values. The above function returns the measurment as a list of objects that are instances of the
         #the measurment class in dls_optimiser_util
@@ -136,6 +134,19 @@ class Optimiser(object):
         unc = measure[0].err
         return (f, unc)
 
+    def getObjectives(self, normParams):
+        '''
+        Evaluates the objective at several points in normalised parameter space at once, so the
+        interactor can batch the measurements. The results are in the order of normParams.
+        '''
+        paramsList = [[self.down[i] + normParam[i]*(self.up[i] - self.down[i]) for i in range(self.paramCount)]
+                      for normParam in normParams]
+        measures = self.interactor.evaluate_many(paramsList)
+        self.numFuncEval += len(measures)
+        if normParams:
+            self.normParam = normParams[-1]
+        return [(measure[0].mean, measure[0].err) for measure in measures]
+
     def bracketMin(self, initialVec, initFunc, searchDirection):
         '''
         Performs the braceting process for line optimisation.
@@ -237,12 +248,11 @@ class Optimiser(object):
         vecFunc0List = sorted(vecFunc0List, key = lambda i: i[2])
         #now only have test points that are suffciently far away from the already known points
         alphaTestList = [i for i in alphaTestList if min([abs(i - j[2]) for j in vecFunc0List]) > delta/2]
-        #now evaluate all the new test points
-        vecFuncTest = []
-        for alpha in alphaTestList:
-            self.normParam = [initialVec[i] + alpha*searchDirection[i] for i in range(self.paramCount)]
-            funcTest = self.getObjective()
-            vecFuncTest.append([self.normParam, funcTest, alpha])
+        #now evaluate all the new test points together
+        testParams = [[initialVec[i] + alpha*searchDirection[i] for i in range(self.paramCount)]
+                      for alpha in alphaTestList]
+        funcTests = self.getObjectives(testParams)
+        vecFuncTest = [[testParams[k], funcTests[k], alphaTestList[k]] for k in range(len(alphaTestList))]
         #now combine all points into one list
         vecFuncList = vecFuncTest + vecFunc0List
         #and sort the list according to the value of alpha
@@ -14,7 +14,7 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
 import cothread
-from . import ca_abstraction_mapping, config, interactors, plot, tkutil, util
+from . import ca_abstraction_mapping, config, interactors, model, plot, recording, tkutil, util
 
 
 class InvalidEntry(Exception):
@@ -310,6 +310,9 @@ class MainWindow(Tkinter.Frame):
 
 
     def close(self):
+        util.close_streams()
+        interactors.close_sim_pools()
+        recording.stop()
         self.parent.destroy()
         cothread.Quit()
 
@@ -338,9 +341,15 @@ class MainWindow(Tkinter.Frame):
 
         ###NOW ACTUALLY CALL THE OPTIMISE FUNCTION WITHIN THE ALGORITHM FILE###
         start_time = time.time()   #START
-        self.parameters.optimiser.optimise()       #OPTIMISING...
+        try:
+            self.parameters.optimiser.optimise()       #OPTIMISING...
+        finally:
+            #the parallel simulator's worker processes are not needed once the run is over
+            interactors.close_sim_pools()
         self.parameters.keepUpdating = False
         end_time = time.time()     #STOP
+        if self.parameters.interactor.cache is not None:
+            print self.parameters.interactor.cache.report()
 
         #now save details for later reference by various code (results plotting, post_analysis etc..)
         self.parameters.interactor.set_mp(self.parameters.initial_settings)
@@ -540,6 +549,7 @@ class MainWindow(Tkinter.Frame):
             config = pickle.load(config_file)
             self.parameters.parameters += config['parameters']
             self.parameters.results += config['results']
+            self.parameters.sim_dimensions = config.get('sim_dimensions')
             config_file.close()
 
             self.Tinput_params.delete(*self.Tinput_params.get_children())
@@ -578,7 +588,8 @@ class MainWindow(Tkinter.Frame):
         config_file = tkFileDialog.asksaveasfile()
         if config_file is not None:
             config = {'parameters': self.parameters.parameters,
-                      'results': self.parameters.results}
+                      'results': self.parameters.results,
+                      'sim_dimensions': self.parameters.sim_dimensions}
 
             pickle.dump(config, config_file)
             config_file.close()
@@ -711,8 +722,37 @@ class AlgorithmSettings(tkutil.DialogBox):
 
         ttk.Separator(self, orient="horizontal").grid(row=1, pady=10, padx=10, sticky=Tkinter.E+Tkinter.W, columnspan=2)
 
+        #off the machine, measurements can be replayed from a trace recorded on the machine, or the
+        #simulator can be run over several processes (left blank, it runs in this process) and
+        #with its model resized to more parameters (left blank, the model keeps its size)
+        self.replay_file = Tkinter.StringVar()
+        self.sim_processes = Tkinter.StringVar()
+        self.sim_dimensions = Tkinter.StringVar()
+        if self.parameters.sim_dimensions is not None:
+            self.sim_dimensions.set(str(self.parameters.sim_dimensions))
+        if not self.parameters.useMachine:
+            sim_frame = Tkinter.Frame(self)
+            sim_frame.grid(row=2, column=0, columnspan=2, sticky=Tkinter.E+Tkinter.W, padx=10)
+            Tkinter.Label(sim_frame, text="Replay trace:").grid(row=0, column=0, sticky=Tkinter.E)
+            Tkinter.Entry(sim_frame, textvariable=self.replay_file).grid(row=0, column=1, sticky=Tkinter.E+Tkinter.W)
+            Tkinter.Button(sim_frame, text="Browse...", command=self.browse_replay_file).grid(row=0, column=2)
+            Tkinter.Label(sim_frame, text="Simulator processes:").grid(row=1, column=0, sticky=Tkinter.E)
+            Tkinter.Entry(sim_frame, textvariable=self.sim_processes, width=6).grid(row=1, column=1, sticky=Tkinter.W)
+            Tkinter.Label(sim_frame, text="Simulator dimensions:").grid(row=2, column=0, sticky=Tkinter.E)
+            Tkinter.Entry(sim_frame, textvariable=self.sim_dimensions, width=6).grid(row=2, column=1, sticky=Tkinter.W)
+            sim_frame.columnconfigure(1, weight=1)
+
         b0 = Tkinter.Button(self, text="Start...", bg="red", command=self.set_settings)
-        b0.grid(row=2, column=1, sticky=Tkinter.E+Tkinter.W)
+        b0.grid(row=3, column=1, sticky=Tkinter.E+Tkinter.W)
+
+    def browse_replay_file(self):
+        """
+        Choose a channel access trace (ca_trace.bin in a machine run's folder) to replay
+        """
+        trace_file = tkFileDialog.askopenfilename(initialdir=self.parameters.save_location,
+                                                  filetypes=[('Channel access traces', '*.bin'), ('All files', '*')])
+        if trace_file:
+            self.replay_file.set(trace_file)
 
     def load_algo_frame(self, file_address):
         """
@@ -733,6 +773,16 @@ class AlgorithmSettings(tkutil.DialogBox):
         self.parameters.reset()
         try:
             algo_settings = self.algo_frame.get_dict()
+            processes = None
+            if self.sim_processes.get().strip():
+                processes = int(self.sim_processes.get())
+                if processes < 1:
+                    raise ValueError('Simulator processes must be at least 1')
+            self.parameters.sim_dimensions = None
+            if self.sim_dimensions.get().strip():
+                self.parameters.sim_dimensions = int(self.sim_dimensions.get())
+                if self.parameters.sim_dimensions < 1:
+                    raise ValueError('Simulator dimensions must be at least 1')
         #settings errors to ensure good data
         except ValueError as ve:
             tkutil.ErrorPopup(
@@ -743,6 +793,10 @@ class AlgorithmSettings(tkutil.DialogBox):
 
             #machine interactor?
             interactor = 'MACHINE' if self.parameters.useMachine else 'SIMULATOR'
+            if not self.parameters.useMachine and self.replay_file.get():
+                interactor = 'REPLAY of {0}'.format(self.replay_file.get())
+            elif not self.parameters.useMachine and processes is not None:
+                interactor = 'SIMULATOR over {0} processes'.format(processes)
 
             ready = tkutil.YesNoPopup.open(
                 self,
@@ -751,9 +805,9 @@ class AlgorithmSettings(tkutil.DialogBox):
                         'Are you sure you wish to start optimisation?')
 
             if ready:
-                self.start(algo_settings)
+                self.start(algo_settings, processes)
 
-    def start(self, algo_settings):
+    def start(self, algo_settings, processes=None):
         mp_addresses = [[mpr.mp_obj for mpr in mpgr.mp_representations]
                 for mpgr in self.parameters.parameters]          #gather machine parameters
         mr_addresses = []
@@ -773,19 +827,74 @@ class AlgorithmSettings(tkutil.DialogBox):
             else:
                 self.parameters.signConverter.append(1)
 
-        #define the appropriate interactor depending on using machine or simulator
-        interactor_class = (interactors.dls_machine_interactor_bulk_base_inj_control
-                            if self.parameters.useMachine
-                            else interactors.sim_machine_interactor_bulk_base)
-        self.parameters.interactor = interactor_class(
-            mp_addresses,
-            mr_addresses,
-            set_relative=relative_settings,
-            results=self.parameters.results
-        )
+        #record the machine's channel access, so the run can be replayed offline
+        if self.parameters.useMachine:
+            recording.start('{0}/ca_trace.bin'.format(self.parameters.store_address))
+
+        #define the appropriate interactor depending on using machine, a replayed trace or simulator
+        replay_file = self.replay_file.get()
+        if not self.parameters.useMachine and replay_file:
+            try:
+                self.parameters.interactor = interactors.replay_machine_interactor_bulk_base(
+                    replay_file,
+                    mp_addresses,
+                    mr_addresses,
+                    set_relative=relative_settings,
+                    results=self.parameters.results
+                )
+            except (IOError, ValueError) as e:
+                tkMessageBox.showerror('Replay error', 'Cannot replay {0}:\n{1}'.format(replay_file, e))
+                return
+        elif not self.parameters.useMachine:
+            if processes is not None:
+                self.parameters.interactor = interactors.parallel_sim_machine_interactor_bulk_base(
+                    mp_addresses,
+                    mr_addresses,
+                    set_relative=relative_settings,
+                    results=self.parameters.results,
+                    processes=processes,
+                    dimensions=self.parameters.sim_dimensions
+                )
+            else:
+                self.parameters.interactor = interactors.sim_machine_interactor_bulk_base(
+                    mp_addresses,
+                    mr_addresses,
+                    set_relative=relative_settings,
+                    results=self.parameters.results,
+                    dimensions=self.parameters.sim_dimensions
+                )
+
+            #a parameter that is not one of the model's (at its size) cannot be simulated
+            unknown = [str(mp.pv) for group in mp_addresses for mp in group
+                       if str(mp.pv) not in model.mach_mapping]
+            if unknown:
+                tkMessageBox.showerror('Simulator error',
+                        'The simulator has no parameters {0}. With {1} dimensions its parameters are {2}'.format(
+                            ', '.join(unknown), len(model.mach_mapping), ', '.join(model.mach_mapping)))
+                return
+        else:
+            try:
+                self.parameters.interactor = interactors.dls_machine_interactor_bulk_base_inj_control(
+                    mp_addresses,
+                    mr_addresses,
+                    set_relative=relative_settings,
+                    results=self.parameters.results
+                )
+            #the machine interactor connects to every PV first, and lists those it cannot reach
+            except util.BulkCaError as e:
+                recording.stop()
+                unreachable = [str(getattr(failure, 'name', failure)) for failure in e.failures]
+                tkMessageBox.showerror('PVs unreachable',
+                        'Cannot {0} to {1} PV(s), the optimisation will not start:\n{2}'.format(
+                            e.operation, len(unreachable), '\n'.join(unreachable)))
+                return
 
         self.parameters.interactor.beam_current_bounds = self.parameters.beam_current_bounds
 
+        #cache results if any parameter has a cache tolerance, so revisited points are not measured again
+        if any(mp.cache_tolerance is not None for group in mp_addresses for mp in group):
+            self.parameters.interactor.enable_cache()
+
         #save the interactor object to file (used in post_analysis file)
         util.save_object(self.parameters.interactor,
                 '{0}/interactor.txt'.format(self.parameters.store_address))
@@ -846,10 +955,29 @@ class AddPv(tkutil.DialogBox):
         self.r1 = Tkinter.Radiobutton(self.frame, text="Define PV change", variable=self.setting_mode, value=1)
         self.r1.grid(row=4, column=2, sticky=Tkinter.E+Tkinter.W)
 
+        #optional readback, used to detect when the parameter has settled (the delay is then an upper bound)
+        Tkinter.Label(self.frame, text="Readback PV:").grid(row=5, column=0, sticky=Tkinter.E)
+        self.i4 = Tkinter.Entry(self.frame)
+        self.i4.grid(row=5, column=1, columnspan=2, sticky=Tkinter.E+Tkinter.W)
+
+        Tkinter.Label(self.frame, text="Readback tolerance:").grid(row=6, column=0, sticky=Tkinter.E)
+        self.i5 = Tkinter.Entry(self.frame)
+        self.i5.grid(row=6, column=1, columnspan=2, sticky=Tkinter.E+Tkinter.W)
+
+        #optional, points this close in the parameter share cached results instead of being measured again
+        Tkinter.Label(self.frame, text="Cache tolerance:").grid(row=7, column=0, sticky=Tkinter.E)
+        self.i6 = Tkinter.Entry(self.frame)
+        self.i6.grid(row=7, column=1, columnspan=2, sticky=Tkinter.E+Tkinter.W)
+
+        #optional, changes of the parameter no larger than this are not written to the machine
+        Tkinter.Label(self.frame, text="Dead band:").grid(row=8, column=0, sticky=Tkinter.E)
+        self.i7 = Tkinter.Entry(self.frame)
+        self.i7.grid(row=8, column=1, columnspan=2, sticky=Tkinter.E+Tkinter.W)
+
         self.b1 = Tkinter.Button(self.frame, text="Cancel", command=self.hide)
-        self.b1.grid(row=5, column=1, sticky=Tkinter.E+Tkinter.W)
+        self.b1.grid(row=9, column=1, sticky=Tkinter.E+Tkinter.W)
         self.b2 = Tkinter.Button(self.frame, text="OK", command=self.add_pv_to_list)
-        self.b2.grid(row=5, column=2, sticky=Tkinter.E+Tkinter.W)
+        self.b2.grid(row=9, column=2, sticky=Tkinter.E+Tkinter.W)
 
         self.frame.pack()
 
@@ -858,7 +986,8 @@ class AddPv(tkutil.DialogBox):
         Once defined, collect PV address + other options and create parameter object
         """
 
-        details = (self.i0.get(), self.i1.get(), self.i2.get(), self.i3.get(), self.setting_mode.get())
+        details = (self.i0.get(), self.i1.get(), self.i2.get(), self.i3.get(), self.setting_mode.get(),
+                   self.i4.get().strip(), self.i5.get().strip(), self.i6.get().strip(), self.i7.get().strip())
         good_data = True
 
         #various errors for bad data
@@ -884,6 +1013,29 @@ class AddPv(tkutil.DialogBox):
             good_data = False
             tkMessageBox.showerror("Input Error", "The delay cannot be converted to a float")
 
+        if details[5]:
+            try:
+                float(details[6])
+            except:
+                good_data = False
+                tkMessageBox.showerror("Input Error", "The readback tolerance cannot be converted to a float")
+
+        if details[7]:
+            try:
+                float(details[7])
+            except:
+                good_data = False
+                tkMessageBox.showerror("Input Error", "The cache tolerance cannot be converted to a float")
+
+        if details[8]:
+            try:
+                if float(details[8]) < 0:
+                    good_data = False
+                    tkMessageBox.showerror("Input Error", "The dead band cannot be negative")
+            except ValueError:
+                good_data = False
+                tkMessageBox.showerror("Input Error", "The dead band cannot be converted to a float")
+
         #now that we have good data, make parameter object
         if good_data:
 
@@ -893,7 +1045,15 @@ class AddPv(tkutil.DialogBox):
             #define parameter object
             mpgr = config.MpGroupRepresentation()
             mpr = config.MpRepresentation()
-            mpr.mp_obj = config.DlsParamVar(details[0], float(details[3]))
+            if details[5]:
+                mpr.mp_obj = config.DlsParamVar(details[0], float(details[3]),
+                                                readback_pv=details[5], tolerance=float(details[6]))
+            else:
+                mpr.mp_obj = config.DlsParamVar(details[0], float(details[3]))
+            if details[7]:
+                mpr.mp_obj.cache_tolerance = float(details[7])
+            if details[8]:
+                mpr.mp_obj.dead_band = float(details[8])
             mpr.list_iid = iid
             mpr.mp_label = details[0]
 
@@ -1367,6 +1527,15 @@ class AddObjFunc(tkutil.DialogBox):
         self.inj_setting = Tkinter.IntVar()
         self.inj_setting.set(0)  # 0 means don't inject, 1 means inject
 
+        self.streaming_setting = Tkinter.BooleanVar()
+        self.streaming_setting.set(False)  # read samples from a camonitor subscription
+
+        self.auto_pace_setting = Tkinter.BooleanVar()
+        self.auto_pace_setting.set(False)  # poll at the update rate of the PV
+
+        self.check_timestamps_setting = Tkinter.BooleanVar()
+        self.check_timestamps_setting.set(True)  # reject stale values by their timestamps
+
         Tkinter.Label(self.frame, text="PV address:").grid(row=0, column=0,
                                                             sticky=Tkinter.E)
         self.i0 = Tkinter.Entry(self.frame)
@@ -1400,12 +1569,35 @@ class AddObjFunc(tkutil.DialogBox):
                                       variable=self.inj_setting, value=1)
         self.r3.grid(row=4, column=1, sticky=Tkinter.W)
 
+        self.c0 = Tkinter.Checkbutton(self.frame, text="Streaming (monitor)",
+                                      variable=self.streaming_setting)
+        self.c0.grid(row=5, column=0, columnspan=2, sticky=Tkinter.W)
+        self.c1 = Tkinter.Checkbutton(self.frame, text="Auto pace",
+                                      variable=self.auto_pace_setting)
+        self.c1.grid(row=5, column=2, sticky=Tkinter.W)
+        self.c2 = Tkinter.Checkbutton(self.frame, text="Check timestamps",
+                                      variable=self.check_timestamps_setting)
+        self.c2.grid(row=6, column=0, columnspan=2, sticky=Tkinter.W)
+
+        # optional adaptive sampling: keep measuring until the standard error reaches the target
+        Tkinter.Label(self.frame, text="Target error:").grid(row=7, column=0,
+                                                              sticky=Tkinter.E)
+        self.i3 = Tkinter.Entry(self.frame)
+        self.i3.grid(row=7, column=1, columnspan=2,
+                     sticky=Tkinter.E + Tkinter.W)
+
+        Tkinter.Label(self.frame, text="Max. measurements:").grid(row=8, column=0,
+                                                                  sticky=Tkinter.E)
+        self.i4 = Tkinter.Entry(self.frame)
+        self.i4.grid(row=8, column=1, columnspan=2,
+                     sticky=Tkinter.E + Tkinter.W)
+
         self.b1 = Tkinter.Button(self.frame, text="Cancel",
                                  command=self.hide)
-        self.b1.grid(row=5, column=1, sticky=Tkinter.E + Tkinter.W)
+        self.b1.grid(row=9, column=1, sticky=Tkinter.E + Tkinter.W)
         self.b2 = Tkinter.Button(self.frame, text="OK",
                                  command=self.add_pv_to_list)
-        self.b2.grid(row=5, column=2, sticky=Tkinter.E + Tkinter.W)
+        self.b2.grid(row=9, column=2, sticky=Tkinter.E + Tkinter.W)
 
         self.frame.pack()
 
@@ -1417,9 +1609,16 @@ class AddObjFunc(tkutil.DialogBox):
         mrr = config.MrRepresentation()
 
         # retrieve information from GUI
+        target_err = self.i3.get().strip()
+        max_counts = self.i4.get().strip()
         mrr.mr_obj = config.DlsMeasurementVar(self.i0.get(),
                                               float(self.i1.get()),
-                                              float(self.i2.get()))
+                                              float(self.i2.get()),
+                                              streaming=self.streaming_setting.get(),
+                                              auto_pace=self.auto_pace_setting.get(),
+                                              check_timestamps=self.check_timestamps_setting.get(),
+                                              target_err=float(target_err) if target_err else None,
+                                              max_counts=float(max_counts) if max_counts else None)
 
         # max/min settings
         if self.max_min_setting.get() == 0:
@@ -5,14 +5,193 @@ APs: Algorithm parameters
 MRs: Machine results (objectives)
 MPs: Machine parameters
 """
-from . import model, util
+from . import model, recording, util, virtual_machine
+from .pv_names import BEAM_CURRENT_PV, INJECTION_START_PV, INJECTION_STOP_PV
 import cothread
-from cothread.catools import caput
+from cothread.catools import camonitor
+import copy
+import math
+import multiprocessing
+import numpy as np
 import pickle
+import random
+import time
 import tkMessageBox
 
 
-class dls_machine_interactor_bulk_base:
+# A rise in the beam current of more than this between DCCT updates is taken to be an injection
+INJECTION_STEP = 0.01
+# Longest time (s) to wait for injection to show on the DCCT after starting it
+INJECTION_TIMEOUT = 4.0
+# Injection has stopped once the beam current has not risen for this long (s), or after
+# STOP_TIMEOUT (s) at most
+INJECTION_QUIET = 0.5
+STOP_TIMEOUT = 1.0
+# Longest time (s) to wait for the beam current to reach its lower bound while injecting
+BEAM_CURRENT_TIMEOUT = 30.0
+# Longest time (s) to wait for a monitor on a timing PV to show a pulse written to it, and how
+# long (s) the pulse is held once it has been seen
+PULSE_TIMEOUT = 1.0
+PULSE_WIDTH = 0.1
+
+# Cached results are measured again once they are older than this (s)
+CACHE_MAX_AGE = 1800.
+# Interval (s) between measurements of the reference point, which check the machine has not
+# drifted since the cached results were measured
+CACHE_REFERENCE_INTERVAL = 300.
+# A reference measurement further than this many standard errors from the last one is drift
+CACHE_DRIFT_SIGMAS = 3.
+
+# Worker pools of the parallel simulator, by number of processes. They are kept here rather
+# than on the interactor, which has to be picklable.
+sim_pools = {}
+# Interval (s) at which the parallel simulator checks for results, sleeping in cothread so the
+# GUI keeps running meanwhile
+SIM_POLL = 0.01
+
+
+class result_cache:
+    """
+    The ARs of points already measured, keyed on their MPs rounded to a tolerance per MP (a
+    tolerance of zero or None only matches exactly). Entries expire after max_age. The first
+    point cached is the reference point: it is measured again every reference_interval, and
+    each entry keeps the reference ARs of when it was measured. An entry whose reference ARs
+    the new reference measurement has moved from by more than drift_sigmas standard errors was
+    measured on a machine that has since drifted, and is dropped; comparing with the reference
+    of each entry, rather than the last reference measurement, also catches slow drift. Times
+    are those of the interactor's clock.
+    """
+
+    # Class level default so that caches pickled without it can still be loaded
+    invalidated_entries = 0
+
+    def __init__(self,
+                 tolerances,
+                 max_age=CACHE_MAX_AGE,
+                 reference_interval=CACHE_REFERENCE_INTERVAL,
+                 drift_sigmas=CACHE_DRIFT_SIGMAS):
+
+        self.tolerances = np.array([tolerance or 0. for tolerance in tolerances], dtype=float)
+        self.max_age = max_age
+        self.reference_interval = reference_interval
+        self.drift_sigmas = drift_sigmas
+
+        # key -> (time measured, time taken to measure, ARs, reference ARs when measured)
+        self.entries = {}
+        # The MPs and ARs of the reference point, and when they were measured
+        self.reference = None
+        self.reference_time = None
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.reference_checks = 0
+        self.invalidations = 0
+        # Time the hits would have taken to measure
+        self.time_saved = 0.
+
+    def key(self, mps):
+        mps = np.asarray(mps, dtype=float)
+        quantised = self.tolerances > 0
+        steps = np.where(quantised, self.tolerances, 1.)
+        return tuple(np.where(quantised, np.round(mps / steps), mps).tolist())
+
+    def get(self, mps, now):
+        """
+        Copies of the cached ARs of mps, or None if they have not been measured recently
+        """
+        key = self.key(mps)
+        entry = self.entries.get(key)
+        if entry is not None and self.max_age is not None and now - entry[0] > self.max_age:
+            del self.entries[key]
+            self.expired += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.time_saved += entry[1]
+        # The optimisers are free to change the measurements they are given
+        return [copy.copy(ar) for ar in entry[2]]
+
+    def add(self, mps, ars, now, duration):
+        # Failed measurements are measured again next time
+        if any(ar.failed for ar in ars):
+            return
+        if self.reference is None:
+            self.reference = (list(mps), [copy.copy(ar) for ar in ars])
+            self.reference_time = now
+        self.entries[self.key(mps)] = (now, duration, [copy.copy(ar) for ar in ars],
+                                       self.reference[1])
+
+    def reference_due(self, now):
+        return (self.reference is not None and self.reference_interval is not None and
+                now - self.reference_time >= self.reference_interval)
+
+    def check_reference(self, ars, now, duration):
+        """
+        Compare a new measurement of the reference point with the reference ARs each entry was
+        measured against, and drop the entries it has drifted from. Returns True if any were
+        dropped.
+        """
+        self.reference_checks += 1
+        self.reference_time = now
+        if any(ar.failed for ar in ars):
+            return False
+
+        mps = self.reference[0]
+        self.reference = (mps, [copy.copy(ar) for ar in ars])
+        drifted = [key for key, entry in self.entries.items()
+                   if any(self.drifted(last, new) for last, new in zip(entry[3], ars))]
+        for key in drifted:
+            del self.entries[key]
+
+        # The reference point itself is now known at the new measurement
+        self.add(mps, ars, now, duration)
+        if not drifted:
+            return False
+        self.invalidations += 1
+        self.invalidated_entries += len(drifted)
+        return True
+
+    def drifted(self, last, new):
+        errors = [ar.err if ar.err is not None and not math.isnan(ar.err) else 0.
+                  for ar in (last, new)]
+        return abs(new.mean - last.mean) > self.drift_sigmas * math.hypot(*errors)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return ('{0} of {1} evaluations from the cache ({2:.0f}%), saving {3:.1f} s; '
+                '{4} entries expired, {5} reference checks, {6} found drift dropping {7} '
+                'entries').format(
+                    self.hits, lookups, 100. * self.hits / lookups if lookups else 0.,
+                    self.time_saved, self.expired, self.reference_checks, self.invalidations,
+                    self.invalidated_entries)
+
+
+class interactor_core:
+    """
+    The mapping between algorithm and machine parameters and results, shared by every
+    interactor. The subclasses are the backends, and provide get_pv, set_pv, set_mp, get_mp and
+    get_mr.
+
+    Each AP is the value of a group of MPs. This is held as NumPy arrays built once from
+    param_var_groups and set_relative, so that the mappings are single array operations:
+    group_index gives the group of every MP, group_starts the first MP of every group, and
+    offsets the initial value of every MP in a relative group (zero otherwise).
+    """
+
+    # The machine parameters as last written by set_mp (None when unknown)
+    last_mps = None
+
+    # Class level default so that interactors pickled before the mapping arrays existed build
+    # them when first used
+    group_index = None
+
+    # The result_cache, once enable_cache has been called
+    cache = None
 
     def __init__(self,
                  param_var_groups=None,
@@ -29,6 +208,8 @@ class dls_machine_interactor_bulk_base:
             for param in group:
                 self.param_vars.append(param)
 
+        self.connect()
+
         if set_relative == None:
             self.set_relative = []
 
@@ -40,95 +221,59 @@ class dls_machine_interactor_bulk_base:
             self.initial_values = self.get_mp()
             self.set_relative = set_relative
 
-
         ''' We create a dictionary to store the input ap keys, with the output mp values '''
         self.ap_to_mp_store = {}
 
+        self.build_mapping()
 
-    def save_details_file(self):
-        return util.save_details_file(self)
+    def connect(self):
+        """
+        Called before the initial values are read. Backends that need to prepare their PVs do it
+        here.
+        """
+        pass
 
-    def get_pv(self, pv):
-        return util.abstract_caget(pv)
+    def build_mapping(self):
+        sizes = [len(group) for group in self.param_var_groups]
+        self.group_index = np.repeat(np.arange(len(sizes)), sizes)
+        self.group_starts = np.cumsum([0] + sizes[:-1])
 
-    def set_pv(self, pv, value):
-        caput(pv, value)
-
-    def ap_to_mp(self, aps):
-
-        mps = []
-
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
+        relative = np.array(self.set_relative, dtype=bool)[self.group_index]
+        if relative.any():
+            self.offsets = np.where(relative, np.asarray(self.initial_values, dtype=float), 0.)
+        else:
+            self.offsets = np.zeros(len(self.group_index))
 
-            for nparam, param in enumerate(group):
+        self.negate = [mrr.mr_to_ar_sign == '-' for mrr in self.results or []]
 
-                if self.set_relative[ngroup] == True:
-                    mps.append(self.initial_values[mpsindex] + aps[ngroup])
+    def save_details_file(self):
+        return util.save_details_file(self)
 
-                else:
-                    mps.append(aps[ngroup])
+    def ap_to_mp(self, aps):
+        if self.group_index is None:
+            self.build_mapping()
 
-                mpsindex += 1
+        mps = (np.asarray(aps, dtype=float)[self.group_index] + self.offsets).tolist()
 
         ''' Store this mapping in the ap_to_mp_store dictionary '''
         self.ap_to_mp_store[tuple(aps)] = tuple(mps)
-        #print self.ap_to_mp_store
 
         return mps
 
     def mp_to_ap(self, mps):
+        if self.group_index is None:
+            self.build_mapping()
 
-        aps = []
-
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
-            print mpsindex
-            if self.set_relative[ngroup]:
-                aps.append(mps[mpsindex] - self.initial_values[mpsindex])
-            elif not self.set_relative[ngroup]:
-                aps.append(mps[mpsindex])
-
-            for nparam, param in enumerate(group):
-                mpsindex += 1
-
-
-        print "mps: {0}".format(mps)
-        print "aps: {0}".format(aps)
-        print "initial values: {0}".format(self.initial_values)
-
-        return aps
+        starts = self.group_starts
+        return (np.asarray(mps, dtype=float)[starts] - self.offsets[starts]).tolist()
 
     def mr_to_ar(self, mrs):
-        # converts a set of machine results to algorithm results
-        ars = []
-
-        mr_to_ar_sign = [mrr.mr_to_ar_sign for mrr in self.results]
-        for mr, sign in zip(mrs, mr_to_ar_sign):
-            if sign == '+':
-                ars.append(mr)
-            elif sign == '-':
-                ars.append(-mr)
-
-        return ars
-
-    def set_mp(self, mps):
-        util.set_params(self.param_vars, mps, caput)
-
-    def get_mp(self):
-        mps = []
-        for param in self.param_vars:
-            print "THIS IS THE PV!: {0}".format(param.pv)
-            print type(param.pv)
-            print param.pv.encode('ascii', 'ignore')
-            print type(param.pv.encode('ascii', 'ignore'))
-            mps.append(util.abstract_caget(param.pv))
+        #converts a set of machine results to algorithm results. Failed measurements keep
+        #their infinite mean, so stay the worst possible result when minimising
+        if self.group_index is None:
+            self.build_mapping()
 
-        return mps
-
-    def get_mr(self):
-        mrs = util.measure_results(self.measurement_vars, util.abstract_caget)
-        return mrs
+        return [-mr if negate and not mr.failed else mr for mr, negate in zip(mrs, self.negate)]
 
     def set_ap(self, aps):
         mps = self.ap_to_mp(aps)
@@ -142,175 +287,185 @@ class dls_machine_interactor_bulk_base:
     def get_ar(self):
         mrs = self.get_mr()
         ars = self.mr_to_ar(mrs)
-
         return ars
 
-    def find_a_bounds(self, param_var_min, param_var_max):
+    def enable_cache(self,
+                     max_age=CACHE_MAX_AGE,
+                     reference_interval=CACHE_REFERENCE_INTERVAL,
+                     drift_sigmas=CACHE_DRIFT_SIGMAS):
+        """
+        Cache the ARs of every point evaluated, to the cache_tolerance of each parameter
+        """
+        self.cache = result_cache([param.cache_tolerance for param in self.param_vars],
+                                  max_age, reference_interval, drift_sigmas)
+
+    def clock(self):
+        """
+        The time (s) by which cache entries are aged
+        """
+        return time.time()
+
+    def evaluate(self, aps):
+        """
+        Set the APs and measure the ARs, unless they are in the cache
+        """
+        if self.cache is None:
+            self.set_ap(aps)
+            return self.get_ar()
+
+        self.check_cache_reference()
+        mps = self.ap_to_mp(aps)
+        ars = self.cache.get(mps, self.clock())
+        if ars is None:
+            start = self.clock()
+            self.set_mp(mps)
+            ars = self.get_ar()
+            self.cache.add(mps, ars, self.clock(), self.clock() - start)
 
-        min_bounds = []
-        max_bounds = []
+        return ars
 
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
+    def check_cache_reference(self):
+        # Measure the reference point again if it is due, to find out if the machine has
+        # drifted away from the cached results
+        if not self.cache.reference_due(self.clock()):
+            return
 
-            if self.set_relative[ngroup]:
-                min = None
-                max = None
+        start = self.clock()
+        mps = self.cache.reference[0]
+        self.set_mp(mps)
+        ars = self.get_ar()
+        if self.cache.check_reference(ars, self.clock(), self.clock() - start):
+            print 'Machine drift at the reference point, drifted cache entries dropped'
+
+    def evaluate_many(self, list_of_aps, order=None, callback=None):
+        """
+        Evaluate every set of APs in list_of_aps, returning their ARs in the same order. This
+        default visits the points one at a time, in order (a list of indices) if it is given;
+        backends can override it to reorder, pipeline or parallelise. callback(index, ars) is
+        called as each point is measured, and if it returns True no more points are measured
+        (their ARs are left as None).
+        """
+        ars_list = [None] * len(list_of_aps)
+        if order is None:
+            order = range(len(list_of_aps))
+
+        for i in order:
+            ars_list[i] = self.evaluate(list_of_aps[i])
+            if callback is not None and callback(i, ars_list[i]):
+                break
+
+        return ars_list
 
-                for param in group:
-                    amount_above = param_var_max[mpsindex] - self.initial_values[mpsindex]
-                    amount_below = param_var_min[mpsindex] - self.initial_values[mpsindex]
+    def find_a_bounds(self, param_var_min, param_var_max):
+        # Every MP in a group must stay within its bounds, so the AP bounds of the group are
+        # the tightest of them
+        if self.group_index is None:
+            self.build_mapping()
 
-                    if min != None:
-                        if amount_below > min:
-                            min = amount_below
-                    else:
-                        min = amount_below
+        lower = np.asarray(param_var_min, dtype=float) - self.offsets
+        upper = np.asarray(param_var_max, dtype=float) - self.offsets
+        min_bounds = np.maximum.reduceat(lower, self.group_starts).tolist()
+        max_bounds = np.minimum.reduceat(upper, self.group_starts).tolist()
 
-                    if max != None:
-                        if amount_above < max:
-                            max = amount_above
-                    else:
-                        max = amount_above
+        return (min_bounds, max_bounds)
 
-                    mpsindex += 1
+    def string_ap_to_mp_store(self):
+        return pickle.dumps(self.ap_to_mp_store)
 
-            else:
-                min = None
-                max = None
 
-                for param in group:
-                    if min != None:
-                        if param_var_min[mpsindex] > min:
-                            min = param_var_min[mpsindex]
-                    else:
-                        min = param_var_min[mpsindex]
+class dls_machine_interactor_bulk_base(interactor_core):
+    """
+    Channel access backend, for running on the machine
+    """
 
-                    if max != None:
-                        if param_var_max[mpsindex] < max:
-                            max = param_var_max[mpsindex]
-                    else:
-                        max = param_var_max[mpsindex]
+    def connect(self):
+        # Connect to every PV up front so the first evaluation is as fast as the rest
+        util.set_timeouts(self.param_vars + self.measurement_vars)
+        util.connect_pvs(self.all_pvs())
 
-                    mpsindex += 1
+    def all_pvs(self):
+        pvs = [param.pv for param in self.param_vars]
+        pvs += [param.readback_pv for param in self.param_vars if param.readback_pv]
+        pvs += [mv.pv for mv in self.measurement_vars]
+        return pvs
 
+    def get_pv(self, pv):
+        return util.abstract_caget(pv)
 
-            min_bounds.append(min)
-            max_bounds.append(max)
+    def set_pv(self, pv, value):
+        util.abstract_caput(pv, value)
+        self.last_mps = None
 
-        print (min_bounds, max_bounds)
-        return (min_bounds, max_bounds)
+    def set_mp(self, mps):
+        # Only write the parameters that have moved since the last set_mp, and so
+        # only wait for their delays
+        changed = util.changed_params(self.param_vars, self.last_mps, mps)
+        try:
+            util.set_params([self.param_vars[i] for i in changed], [mps[i] for i in changed],
+                            util.abstract_caput_list, bulk=True,
+                            settle_command=util.wait_for_readbacks)
+        except:
+            self.last_mps = None
+            raise
+
+        if self.last_mps is None:
+            self.last_mps = list(mps)
+        for i in changed:
+            self.last_mps[i] = mps[i]
 
-    def string_ap_to_mp_store(self):
-        print self.ap_to_mp_store
-        return pickle.dumps(self.ap_to_mp_store)
+    def get_mp(self):
+        return util.abstract_caget_list([param.pv for param in self.param_vars])
+
+    def get_mr(self):
+        mrs = util.measure_with_policy(
+            lambda: util.measure_results(self.measurement_vars, util.abstract_caget_stamped,
+                                         util.stream_samples),
+            self.measurement_vars)
+        return mrs
 
 ###################################################  MAIN INTERACTOR FOR BASIC (SIMULATION) #############################################
 
-#Many of the functions within this class are used in main.py and the algorithm files. The most important to understand is get_mr.
 
-class sim_machine_interactor_bulk_base:
+class sim_machine_interactor_bulk_base(interactor_core):
+    """
+    Simulation backend, using the test problems in model.py. If dimensions is given, the model
+    is resized to that many parameters (see model.resize) first, so test problems can be run at
+    higher dimensions.
+    """
+
+    # Class level default so that interactors pickled without it can still be loaded
+    dimensions = None
 
     def __init__(self,
                  param_var_groups=None,
                  measurement_vars=None,
                  set_relative=None,
-                 results=None):
+                 results=None,
+                 dimensions=None):
 
-        self.param_var_groups = param_var_groups
-        self.measurement_vars = measurement_vars
-        self.results = results
-
-        self.param_vars = []
-        for group in self.param_var_groups:
-            for param in group:
-                self.param_vars.append(param)
-
-        if set_relative == None:
-            self.set_relative = []
-
-            for i in self.param_var_groups:
-                self.set_relative.append(False)
-
-        # If we need to do relative setting, we need the initial values
-        if set_relative != None:
-            self.initial_values = self.get_mp()
-            self.set_relative = set_relative
-
-
-        ''' We create a dictionary to store the input ap keys, with the output mp values '''
-        self.ap_to_mp_store = {}
-
-
-    def save_details_file(self):
-        return util.save_details_file(self)
+        self.dimensions = dimensions
+        if dimensions is not None:
+            model.resize(dimensions)
+        interactor_core.__init__(self, param_var_groups, measurement_vars, set_relative, results)
 
     def get_pv(self, pv):
         return model.caget(pv)
 
     def set_pv(self, pv, value):
         model.caput(pv, value)
-
-    def ap_to_mp(self, aps):
-
-        mps = []
-
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
-
-            for nparam, param in enumerate(group):
-
-                if self.set_relative[ngroup] == True:
-                    mps.append(self.initial_values[mpsindex] + aps[ngroup])
-
-                else:
-                    mps.append(aps[ngroup])
-
-                mpsindex += 1
-
-        ''' Store this mapping in the ap_to_mp_store dictionary '''
-        self.ap_to_mp_store[tuple(aps)] = tuple(mps)
-        #print self.ap_to_mp_store
-
-        return mps
-
-    def mp_to_ap(self, mps):
-
-        aps = []
-
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
-            print mpsindex
-            if self.set_relative[ngroup]:
-                aps.append(mps[mpsindex] - self.initial_values[mpsindex])
-            elif not self.set_relative[ngroup]:
-                aps.append(mps[mpsindex])
-
-            for nparam, param in enumerate(group):
-                mpsindex += 1
-
-
-        print "mps: {0}".format(mps)
-        print "aps: {0}".format(aps)
-        print "initial values: {0}".format(self.initial_values)
-
-        return aps
-
-    def mr_to_ar(self, mrs):
-        #converts a set of machine results to algorithm results
-        ars = []
-
-        mr_to_ar_sign = [mrr.mr_to_ar_sign for mrr in self.results]
-        for mr, sign in zip(mrs, mr_to_ar_sign):
-            if sign == '+':
-                ars.append(mr)
-            elif sign == '-':
-                ars.append(-mr)
-
-        return ars
+        self.last_mps = None
 
     def set_mp(self, mps):
-        util.set_params(self.param_vars, mps, model.caput)
+        # Only write the parameters that have moved since the last set_mp, and so
+        # only wait for their delays
+        changed = util.changed_params(self.param_vars, self.last_mps, mps)
+        util.set_params([self.param_vars[i] for i in changed], [mps[i] for i in changed],
+                        model.caput)
+
+        if self.last_mps is None:
+            self.last_mps = list(mps)
+        for i in changed:
+            self.last_mps[i] = mps[i]
 
     def get_mp(self):
         mps = []
@@ -323,235 +478,414 @@ class sim_machine_interactor_bulk_base:
         mrs = util.measure_results(self.measurement_vars, model.caget)
         return mrs
 
-    def set_ap(self, aps):
-        mps = self.ap_to_mp(aps)
-        self.set_mp(mps)
-
-    def get_ap(self):
-        mps = self.get_mp()
-        aps = self.mp_to_ap(mps)
-        return aps
 
-    def get_ar(self):
-        mrs = self.get_mr()
-        ars = self.mr_to_ar(mrs)
-        return ars
+def seed_worker():
+    # Forked workers inherit the parent's random state, so would all add the same noise
+    random.seed()
 
-    def find_a_bounds(self, param_var_min, param_var_max):
 
-        min_bounds = []
-        max_bounds = []
+def sim_pool(processes):
+    if processes not in sim_pools:
+        sim_pools[processes] = multiprocessing.Pool(processes, initializer=seed_worker)
+    return sim_pools[processes]
 
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
 
-            if self.set_relative[ngroup]:
-                min = None
-                max = None
+def close_sim_pools():
+    for pool in sim_pools.values():
+        pool.terminate()
+    sim_pools.clear()
 
-                for param in group:
-                    amount_above = param_var_max[mpsindex] - self.initial_values[mpsindex]
-                    amount_below = param_var_min[mpsindex] - self.initial_values[mpsindex]
 
-                    if min != None:
-                        if amount_below > min:
-                            min = amount_below
-                    else:
-                        min = amount_below
+def sim_evaluate(task):
+    """
+    Measure every objective at one point of the model, in a worker process. task is the
+    complete model setting and the measurement variables.
+    """
+    settings, measurement_vars = task
+    mrs = []
+    for measurement_var in measurement_vars:
+        statistics = util.running_statistics()
+        samples = []
+        while True:
+            value = model.measure(measurement_var.pv, settings)
+            samples.append(value)
+            statistics.add(value)
+            if util.enough_samples(measurement_var, statistics):
+                break
 
-                    if max != None:
-                        if amount_above < max:
-                            max = amount_above
-                    else:
-                        max = amount_above
+        statistics = util.clipped_statistics(samples, robust=measurement_var.robust)
+        mrs.append(util.measurement(mean=statistics.mean, counts=statistics.count,
+                                    dev=statistics.deviation(), err=statistics.error()))
 
-                    mpsindex += 1
+    return mrs
 
-            else:
-                min = None
-                max = None
 
-                for param in group:
-                    if min != None:
-                        if param_var_min[mpsindex] > min:
-                            min = param_var_min[mpsindex]
-                    else:
-                        min = param_var_min[mpsindex]
+def sim_evaluate_chunk(chunk):
+    # The index of each point is sent back with its results, as chunks arrive in any order
+    return [(index, sim_evaluate(task)) for index, task in chunk]
 
-                    if max != None:
-                        if param_var_max[mpsindex] < max:
-                            max = param_var_max[mpsindex]
-                    else:
-                        max = param_var_max[mpsindex]
 
-                    mpsindex += 1
+class parallel_sim_machine_interactor_bulk_base(sim_machine_interactor_bulk_base):
+    """
+    Simulation backend for evaluate_many that farms the points out over a pool of processes.
+    Each point carries its own copy of the model setting, so evaluating it does not touch
+    model.mach_setting. The model has no dynamics, so measurement delays are not waited for.
+    """
 
+    # Class level default so that interactors pickled without it can still be loaded
+    processes = None
 
-            min_bounds.append(min)
-            max_bounds.append(max)
+    def __init__(self,
+                 param_var_groups=None,
+                 measurement_vars=None,
+                 set_relative=None,
+                 results=None,
+                 processes=None,
+                 dimensions=None):
+
+        self.processes = processes or multiprocessing.cpu_count()
+        # Workers already running were forked with the model at its old size
+        if dimensions is not None:
+            close_sim_pools()
+        sim_machine_interactor_bulk_base.__init__(self, param_var_groups, measurement_vars,
+                                                  set_relative, results, dimensions)
+
+    def evaluate_many(self, list_of_aps, order=None, callback=None):
+        """
+        As interactor_core.evaluate_many, but the points are measured in parallel and callback
+        is called as the results of each arrive, in any order. Returning True from it stops the
+        worker processes, leaving the ARs of the points still being measured as None.
+        """
+        processes = self.processes or multiprocessing.cpu_count()
+        indices = [model.mach_mapping.index(param.pv) for param in self.param_vars]
+        list_of_mps = [self.ap_to_mp(aps) for aps in list_of_aps]
+
+        ars_list = [None] * len(list_of_aps)
+        if self.cache is not None:
+            self.check_cache_reference()
+            now = self.clock()
+            ars_list = [self.cache.get(mps, now) for mps in list_of_mps]
+        todo = [i for i in range(len(list_of_aps)) if ars_list[i] is None]
+
+        # Points found in the cache are reported first
+        if callback is not None:
+            for i in range(len(ars_list)):
+                if ars_list[i] is not None and callback(i, ars_list[i]):
+                    return ars_list
+
+        points = []
+        for i in todo:
+            settings = list(model.mach_setting)
+            for index, mp in zip(indices, list_of_mps[i]):
+                settings[index] = mp
+            points.append((i, (settings, self.measurement_vars)))
+        if not points:
+            return ars_list
+
+        # A few chunks per process keeps the workers evenly loaded without sending every
+        # point separately. The results are polled for, as waiting on the pool would block
+        # every cothread (and so the GUI, and pausing or cancelling) until the batch was done.
+        start = self.clock()
+        chunksize = max(1, len(points) // (4 * processes))
+        chunks = [points[i:i + chunksize] for i in range(0, len(points), chunksize)]
+        results = sim_pool(processes).imap_unordered(sim_evaluate_chunk, chunks)
+        count = 0
+        for chunk in chunks:
+            while True:
+                try:
+                    chunk_results = results.next(0)
+                    break
+                except multiprocessing.TimeoutError:
+                    cothread.Sleep(SIM_POLL)
+
+            for i, mrs in chunk_results:
+                # The points are measured together, so each is taken to have cost an equal
+                # share
+                count += 1
+                ars_list[i] = self.mr_to_ar(mrs)
+                if self.cache is not None:
+                    now = self.clock()
+                    self.cache.add(list_of_mps[i], ars_list[i], now, (now - start) / count)
+                if callback is not None and callback(i, ars_list[i]):
+                    # The rest of the batch is not wanted, so stop the workers measuring it
+                    close_sim_pools()
+                    return ars_list
+
+        return ars_list
+
+
+class virtual_machine_interactor_bulk_base(interactor_core):
+    """
+    Backend for the virtual machine in virtual_machine.py. Every operation takes as long as it
+    would on the machine, in virtual time, so the optimisers can be timed end to end.
+    """
 
-        print (min_bounds, max_bounds)
-        return (min_bounds, max_bounds)
+    def __init__(self,
+                 param_var_groups=None,
+                 measurement_vars=None,
+                 set_relative=None,
+                 results=None,
+                 machine=None):
 
-    def string_ap_to_mp_store(self):
-        print self.ap_to_mp_store
-        return pickle.dumps(self.ap_to_mp_store)
+        self.machine = machine or virtual_machine.virtual_machine()
+        interactor_core.__init__(self, param_var_groups, measurement_vars, set_relative, results)
 
-######################################################### END OF USEFUL CLASSES/FUNCTIONS ##########################################
+    def clock(self):
+        return self.machine.clock.time
 
-# the remaining classes/functions are not used in injection that often and are not important in understanding how the file works.
+    def get_pv(self, pv):
+        return self.machine.get([pv])[0]
 
-class dls_machine_interactor_bulk_base_inj_control:
+    def set_pv(self, pv, value):
+        self.machine.put([pv], [value])
+        self.last_mps = None
 
-    def __init__(self, param_var_groups=None, measurement_vars=None,
-                 set_relative=None, results=None):
+    def set_mp(self, mps):
+        # Only write the parameters that have moved since the last set_mp, and so
+        # only wait for their delays
+        changed = util.changed_params(self.param_vars, self.last_mps, mps)
+        self.machine.set_params([self.param_vars[i] for i in changed], [mps[i] for i in changed])
 
-        self.param_var_groups = param_var_groups
-        self.measurement_vars = measurement_vars
-        self.measurement_vars_noinj = [mv for mv in measurement_vars if not mv.inj_setting]
-        self.measurement_vars_inj = [mv for mv in measurement_vars if mv.inj_setting]
-        self.results = results
-        self.beam_current_bounds = None, None
+        if self.last_mps is None:
+            self.last_mps = list(mps)
+        for i in changed:
+            self.last_mps[i] = mps[i]
 
-        self.param_vars = []
-        for group in self.param_var_groups:
-            for param in group:
-                self.param_vars.append(param)
+    def get_mp(self):
+        return self.machine.get([param.pv for param in self.param_vars])
 
-        if set_relative == None:
-            self.set_relative = []
+    def get_mr(self):
+        return util.measure_with_policy(self.measure_mr, self.measurement_vars)
+
+    def measure_mr(self):
+        all_samples = self.machine.measure(self.measurement_vars)
+
+        # Samples taken while the beam was lost fail the measurement. The beam is waited for,
+        # as it would be on the machine, before the failure policy measures again.
+        lost = [mv.pv for mv, samples in zip(self.measurement_vars, all_samples)
+                if any(np.isnan(samples))]
+        if lost:
+            self.machine.wait_for_beam()
+            raise util.BulkCaError('measure', ['{0}: beam lost'.format(pv) for pv in lost])
+
+        mrs = []
+        for measurement_var, samples in zip(self.measurement_vars, all_samples):
+            statistics = util.clipped_statistics(samples, robust=measurement_var.robust)
+            mrs.append(util.measurement(mean=statistics.mean, counts=statistics.count,
+                                        dev=statistics.deviation(), err=statistics.error()))
+        return mrs
 
-            for i in self.param_var_groups:
-                self.set_relative.append(False)
+    def get_ar(self):
+        ars = interactor_core.get_ar(self)
+        self.machine.record(ars)
+        return ars
 
-        # If we need to do relative setting, we need the initial values
-        if set_relative != None:
-            self.initial_values = self.get_mp()
-            self.set_relative = set_relative
 
-        # We create a dictionary to store the input ap keys,
-        # with the output mp values
-        self.ap_to_mp_store = {}
+class replay_machine_interactor_bulk_base(sim_machine_interactor_bulk_base):
+    """
+    Serves measurements from a channel access trace recorded on the machine (see recording.py),
+    so that algorithms can be re-run without beam time. A setting that was measured in the trace
+    is replayed exactly; any other setting gets the samples of the nearest recorded setting.
+    Nothing waits unless speedup is given, in which case each measurement takes its recorded
+    time divided by speedup.
+    """
 
-    def save_details_file(self):
-        return util.save_details_file(self)
+    def __init__(self,
+                 trace_filename,
+                 param_var_groups=None,
+                 measurement_vars=None,
+                 set_relative=None,
+                 results=None,
+                 speedup=None):
+
+        self.trace_filename = trace_filename
+        self.speedup = speedup
+        param_pvs = [param.pv for group in param_var_groups for param in group]
+        self.trace = recording.trace_index(trace_filename, param_pvs,
+                                           [mv.pv for mv in measurement_vars])
+        if self.trace.initial_settings is None or not self.trace.points:
+            raise ValueError('{0} does not record the parameters {1} being measured'.format(
+                trace_filename, param_pvs))
+
+        # The replayed machine state, and how each setting has been served
+        self.mps = list(self.trace.initial_settings)
+        self.exact_matches = 0
+        self.nearest_matches = 0
+
+        sim_machine_interactor_bulk_base.__init__(self, param_var_groups, measurement_vars,
+                                                  set_relative, results)
 
     def get_pv(self, pv):
-        return util.abstract_caget(pv)
+        pvs = [str(param.pv) for param in self.param_vars]
+        if str(pv) in pvs:
+            return self.mps[pvs.index(str(pv))]
+        setting, exact = self.trace.nearest(self.mps, [param.dead_band for param in self.param_vars])
+        return self.trace.points[setting][str(pv)][-1]
 
     def set_pv(self, pv, value):
-        caput(pv, value)
-
-    def ap_to_mp(self, aps):
-
-        mps = []
+        pvs = [str(param.pv) for param in self.param_vars]
+        self.mps[pvs.index(str(pv))] = value
+        self.last_mps = None
 
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
-
-            for nparam, param in enumerate(group):
-
-                if self.set_relative[ngroup] == True:
-                    mps.append(self.initial_values[mpsindex] + aps[ngroup])
-
-                else:
-                    mps.append(aps[ngroup])
-
-                mpsindex += 1
-
-        ''' Store this mapping in the ap_to_mp_store dictionary '''
-        self.ap_to_mp_store[tuple(aps)] = tuple(mps)
-
-        return mps
-
-    def mp_to_ap(self, mps):
+    def set_mp(self, mps):
+        # Parameters that moved no further than their dead band were not written on the machine
+        # either, so the replayed setting is the full machine setting the trace would show
+        changed = util.changed_params(self.param_vars, self.last_mps, mps)
+        for i in changed:
+            self.mps[i] = mps[i]
 
-        aps = []
+        if self.last_mps is None:
+            self.last_mps = list(mps)
+        for i in changed:
+            self.last_mps[i] = mps[i]
 
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
-            print mpsindex
-            if self.set_relative[ngroup]:
-                aps.append(mps[mpsindex] - self.initial_values[mpsindex])
-            elif not self.set_relative[ngroup]:
-                aps.append(mps[mpsindex])
+    def get_mp(self):
+        return list(self.mps)
 
-            for nparam, param in enumerate(group):
-                mpsindex += 1
+    def get_mr(self):
+        setting, exact = self.trace.nearest(self.mps, [param.dead_band for param in self.param_vars])
+        if exact:
+            self.exact_matches += 1
+        else:
+            self.nearest_matches += 1
+
+        if self.speedup:
+            cothread.Sleep(self.trace.durations.get(setting, 0.) / self.speedup)
+
+        mrs = []
+        for measurement_var in self.measurement_vars:
+            samples = self.trace.points[setting].get(str(measurement_var.pv))
+            if not samples:
+                inf = float('inf')
+                mrs.append(util.measurement(mean=inf, dev=inf, counts=0, err=inf, failed=True))
+                continue
+            statistics = util.clipped_statistics(samples, robust=measurement_var.robust)
+            mrs.append(util.measurement(mean=statistics.mean, counts=statistics.count,
+                                        dev=statistics.deviation(), err=statistics.error()))
 
-        print "mps: {0}".format(mps)
-        print "aps: {0}".format(aps)
-        print "initial values: {0}".format(self.initial_values)
+        return mrs
 
-        return aps
+######################################################### END OF USEFUL CLASSES/FUNCTIONS ##########################################
 
-    def mr_to_ar(self, mrs):
-        #converts a set of machine results to algorithm results
-        ars = []
+# the remaining classes/functions are not used in injection that often and are not important in understanding how the file works.
 
-        mr_to_ar_sign = [mrr.mr_to_ar_sign for mrr in self.results]
-        for mr, sign in zip(mrs, mr_to_ar_sign):
-            if sign == '+':
-                ars.append(mr)
-            elif sign == '-':
-                ars.append(-mr)
+class beam_current_monitor:
+    """
+    Follows the beam current with a camonitor, so that the injection cycle can wait for events
+    on the DCCT instead of for fixed times.
+    """
+
+    def __init__(self, pv=BEAM_CURRENT_PV):
+        self.current = None
+        self.peak = None
+        # Number of rises seen, and the time of the last one
+        self.rises = 0
+        self.last_rise = None
+        self.updated = cothread.Event()
+        self.subscription = camonitor(pv, self.on_update)
+
+    def on_update(self, value):
+        if self.current is not None and value > self.current + INJECTION_STEP:
+            self.rises += 1
+            self.last_rise = time.time()
+        self.current = value
+        if self.peak is None or value > self.peak:
+            self.peak = value
+        self.updated.Signal()
+
+    def wait(self, condition, timeout=None):
+        """
+        Wait until condition() is true, checking it on every update of the beam current. Returns
+        False if the timeout expires first.
+        """
+        deadline = cothread.AbsTimeout(timeout) if timeout is not None else None
+        while not condition():
+            try:
+                self.updated.Wait(deadline)
+            except cothread.Timedout:
+                return condition()
+        return True
+
+    def wait_quiet(self, quiet, timeout):
+        """
+        Wait until the beam current has not risen for quiet seconds, or for timeout at most.
+        """
+        start = time.time()
+        while True:
+            quiet_since = max(self.last_rise or start, start)
+            wait = min(quiet_since + quiet, start + timeout) - time.time()
+            if wait <= 0:
+                break
+            cothread.Sleep(wait)
+
+    def close(self):
+        self.subscription.close()
+
+
+def timing_pulse(pv):
+    """
+    Pulse a timing PV: write 1, wait until a monitor on the PV shows that the timing system has
+    taken it, hold it for PULSE_WIDTH and write 0. The writes go through util, so are retried
+    and recorded like any other. Raises BulkCaError if the pulse is not seen within
+    PULSE_TIMEOUT.
+    """
+    seen = cothread.Event()
+    subscription = camonitor(pv, lambda value: value and seen.Signal())
+    try:
+        util.abstract_caput(pv, 1)
+        try:
+            seen.Wait(PULSE_TIMEOUT)
+        except cothread.Timedout:
+            raise util.BulkCaError('caput', ['{0}: pulse not seen after {1} s'.format(
+                pv, PULSE_TIMEOUT)])
+        cothread.Sleep(PULSE_WIDTH)
+    finally:
+        util.abstract_caput(pv, 0)
+        subscription.close()
+
+
+class dls_machine_interactor_bulk_base_inj_control(dls_machine_interactor_bulk_base):
+    """
+    Channel access backend that also controls injection, for objectives that need it
+    """
 
-        return ars
+    def __init__(self, param_var_groups=None, measurement_vars=None,
+                 set_relative=None, results=None):
 
-    def set_mp(self, mps):
-        util.set_params(self.param_vars, mps, caput)
+        self.measurement_vars_noinj = [mv for mv in measurement_vars if not mv.inj_setting]
+        self.measurement_vars_inj = [mv for mv in measurement_vars if mv.inj_setting]
+        self.beam_current_bounds = None, None
 
-    def get_mp(self):
-        mps = []
-        for param in self.param_vars:
-            mps.append(util.abstract_caget(param.pv))
+        dls_machine_interactor_bulk_base.__init__(self, param_var_groups, measurement_vars,
+                                                  set_relative, results)
 
-        return mps
+    def all_pvs(self):
+        pvs = dls_machine_interactor_bulk_base.all_pvs(self)
+        if self.measurement_vars_inj:
+            pvs += [INJECTION_START_PV, INJECTION_STOP_PV, BEAM_CURRENT_PV]
+        return pvs
 
     # - MOST IMPORTANT FUNCTION IN CLASS FOR INJECTION CONTROL - #
 
     def get_mr(self):
-        get_command = util.abstract_caget
-        beam_current_max_warning = False
+        # The results are returned non-injection first, as measure_mr does
+        return util.measure_with_policy(self.measure_mr,
+                                        self.measurement_vars_noinj + self.measurement_vars_inj)
 
+    def measure_mr(self):
         # Only control injection if there are variables that require it.
-        if self.measurement_vars_inj:
-            # First measure the injection results
-            # Begin injecting
-            print "Start injection"
-            caput('LI-TI-MTGEN-01:START', 1)
-            cothread.Sleep(0.1)
-            caput('LI-TI-MTGEN-01:START', 0)
-            cothread.Sleep(4.0)
-
-            if self.beam_current_bounds[0] is not None:
-                beam_current = get_command('SR-DI-DCCT-01:SIGNAL')
-                while beam_current < self.beam_current_bounds[0]:
-                    print 'waiting for beam current to rise above ', \
-                        self.beam_current_bounds[0]
-                    cothread.Sleep(1)
-                    beam_current = get_command('SR-DI-DCCT-01:SIGNAL')
-                    print '...'
-
-            mrs_inj = util.measure_results(self.measurement_vars_inj,
-                                           util.abstract_caget)
-
-            # Now for the non-injection measurements
-            if self.beam_current_bounds[1] is not None:
-                if get_command('SR-DI-DCCT-01:SIGNAL') > self.beam_current_bounds[1]:
-                    beam_current_max_warning = True
-
-            # Stop injection
-            print "Stop injection"
-            caput('LI-TI-MTGEN-01:STOP', 1)
-            cothread.Sleep(0.1)
-            caput('LI-TI-MTGEN-01:STOP', 0)
-            cothread.Sleep(1)
-        else:
-            mrs_inj = []
-
-        mrs_noinj = util.measure_results(self.measurement_vars_noinj,
-                                         util.abstract_caget)
+        if not self.measurement_vars_inj:
+            return util.measure_results(self.measurement_vars_noinj,
+                                        util.abstract_caget_stamped, util.stream_samples)
+
+        # The non-injection objectives are measured while the injection cycle runs
+        noinj = cothread.Spawn(util.measure_results, self.measurement_vars_noinj,
+                               util.abstract_caget_stamped, util.stream_samples,
+                               raise_on_wait=True)
+        try:
+            mrs_inj, beam_current_max_warning = self.injection_cycle()
+        finally:
+            mrs_noinj = noinj.Wait()
 
         # Now combine the results into a single list
         mrs = mrs_noinj + mrs_inj
@@ -562,79 +896,58 @@ class dls_machine_interactor_bulk_base_inj_control:
 
         return mrs
 
-    # -----------------------------------------------------------------------
-
-    def set_ap(self, aps):
-        mps = self.ap_to_mp(aps)
-        self.set_mp(mps)
-
-    def get_ap(self):
-        mps = self.get_mp()
-        aps = self.mp_to_ap(mps)
-        return aps
-
-    def get_ar(self):
-        mrs = self.get_mr()
-        ars = self.mr_to_ar(mrs)
-        return ars
-
-    def find_a_bounds(self, param_var_min, param_var_max):
-
-        min_bounds = []
-        max_bounds = []
-
-        mpsindex = 0
-        for ngroup, group in enumerate(self.param_var_groups):
-
-            if self.set_relative[ngroup]:
-                min = None
-                max = None
-
-                for param in group:
-                    amount_above = param_var_max[mpsindex] - \
-                                   self.initial_values[mpsindex]
-                    amount_below = param_var_min[mpsindex] - \
-                                   self.initial_values[mpsindex]
-
-                    if min != None:
-                        if amount_below > min:
-                            min = amount_below
-                    else:
-                        min = amount_below
-
-                    if max != None:
-                        if amount_above < max:
-                            max = amount_above
-                    else:
-                        max = amount_above
-
-                    mpsindex += 1
-
-            else:
-                min = None
-                max = None
-
-                for param in group:
-                    if min != None:
-                        if param_var_min[mpsindex] > min:
-                            min = param_var_min[mpsindex]
-                    else:
-                        min = param_var_min[mpsindex]
-
-                    if max != None:
-                        if param_var_max[mpsindex] < max:
-                            max = param_var_max[mpsindex]
-                    else:
-                        max = param_var_max[mpsindex]
+    def injection_cycle(self):
+        """
+        Inject, measure the injection objectives, and stop injecting. Every wait has a timeout,
+        and a DCCT or timing system that does not respond raises BulkCaError, so that the
+        failure policy applies. Returns the injection results and whether the beam current
+        exceeded its upper bound.
+        """
+        beam_current_max_warning = False
 
-                    mpsindex += 1
+        # The beam current is monitored rather than polled, so that each step of the
+        # injection cycle starts as soon as the beam is ready for it
+        beam = beam_current_monitor()
+        injecting = False
+        try:
+            if not beam.wait(lambda: beam.current is not None, INJECTION_TIMEOUT):
+                raise util.BulkCaError('camonitor', ['{0}: no update after {1} s'.format(
+                    BEAM_CURRENT_PV, INJECTION_TIMEOUT)])
 
-            min_bounds.append(min)
-            max_bounds.append(max)
+            # First measure the injection results
+            # Begin injecting
+            print "Start injection"
+            rises = beam.rises
+            injecting = True
+            timing_pulse(INJECTION_START_PV)
+            if not beam.wait(lambda: beam.rises > rises, INJECTION_TIMEOUT):
+                print 'No injection seen on the DCCT after {0} s'.format(INJECTION_TIMEOUT)
+
+            lower = self.beam_current_bounds[0]
+            if lower is not None and beam.current < lower:
+                print 'waiting for beam current to rise above ', lower
+                if not beam.wait(lambda: beam.current >= lower, BEAM_CURRENT_TIMEOUT):
+                    raise util.BulkCaError('camonitor', [
+                        '{0}: still below {1} after {2} s'.format(
+                            BEAM_CURRENT_PV, lower, BEAM_CURRENT_TIMEOUT)])
 
-        print (min_bounds, max_bounds)
-        return (min_bounds, max_bounds)
+            mrs_inj = util.measure_results(self.measurement_vars_inj,
+                                           util.abstract_caget_stamped,
+                                           util.stream_samples)
 
-    def string_ap_to_mp_store(self):
-        print self.ap_to_mp_store
-        return pickle.dumps(self.ap_to_mp_store)
+            # The highest current seen while injecting is checked against the upper bound
+            if self.beam_current_bounds[1] is not None:
+                if beam.peak > self.beam_current_bounds[1]:
+                    beam_current_max_warning = True
+        finally:
+            # Stop injection, even if the cycle failed, and wait until the DCCT shows it has
+            # stopped
+            if injecting:
+                print "Stop injection"
+                try:
+                    timing_pulse(INJECTION_STOP_PV)
+                finally:
+                    beam.wait_quiet(INJECTION_QUIET, STOP_TIMEOUT)
+            beam.close()
+
+        return mrs_inj, beam_current_max_warning
@@ -2,6 +2,7 @@ from __future__ import division
 
 import random
 import math
+import numpy as np
 
 
 def kur(x):
@@ -32,77 +33,321 @@ def matFunc(x):
     return f
 
 
+######################## VECTORISED TEST PROBLEMS ########################
+
+# Each function takes a population matrix X (one row per individual, one column per
+# parameter) and returns all of the objectives together, one row per individual. Any number of
+# parameters can be used. ZDT and DTLZ parameters are in [0, 1] (except the later parameters of
+# ZDT4, in [-5, 5]); KUR parameters are in [-5, 5].
+
+def zdt_g(X):
+    return 1 + 9 * X[:, 1:].sum(axis=1) / max(X.shape[1] - 1, 1)
+
+
+def zdt1(X):
+    f1 = X[:, 0]
+    g = zdt_g(X)
+    return np.column_stack((f1, g * (1 - np.sqrt(f1 / g))))
+
+
+def zdt2(X):
+    f1 = X[:, 0]
+    g = zdt_g(X)
+    return np.column_stack((f1, g * (1 - (f1 / g) ** 2)))
+
+
+def zdt3(X):
+    f1 = X[:, 0]
+    g = zdt_g(X)
+    return np.column_stack((f1, g * (1 - np.sqrt(f1 / g) - f1 / g * np.sin(10 * np.pi * f1))))
+
+
+def zdt4(X):
+    f1 = X[:, 0]
+    rest = X[:, 1:]
+    g = 1 + 10 * rest.shape[1] + (rest ** 2 - 10 * np.cos(4 * np.pi * rest)).sum(axis=1)
+    return np.column_stack((f1, g * (1 - np.sqrt(f1 / g))))
+
+
+def zdt5(X):
+    # ZDT5 is defined on bit strings: 30 bits for the first parameter and 5 for the rest.
+    # Here each parameter in [0, 1] gives the number of ones in its string.
+    u1 = np.round(X[:, 0] * 30)
+    u = np.round(X[:, 1:] * 5)
+    v = np.where(u < 5, 2 + u, 1)
+    f1 = 1 + u1
+    return np.column_stack((f1, v.sum(axis=1) / f1))
+
+
+def zdt6(X):
+    x1 = X[:, 0]
+    f1 = 1 - np.exp(-4 * x1) * np.sin(6 * np.pi * x1) ** 6
+    g = 1 + 9 * (X[:, 1:].sum(axis=1) / max(X.shape[1] - 1, 1)) ** 0.25
+    return np.column_stack((f1, g * (1 - (f1 / g) ** 2)))
+
+
+def linear_front(X, scale):
+    """
+    DTLZ1 objectives: products of the first parameters and one minus the next
+    """
+    n, m = X.shape[0], X.shape[1] + 1
+    products = np.cumprod(np.column_stack((np.ones(n), X)), axis=1)
+    F = np.empty((n, m))
+    for i in range(m):
+        F[:, i] = products[:, m - 1 - i]
+        if i > 0:
+            F[:, i] *= 1 - X[:, m - 1 - i]
+    return F * scale[:, None]
+
+
+def spherical_front(theta, scale):
+    """
+    DTLZ2-6 objectives: products of cosines of the angles theta and the sine of the next
+    """
+    n, m = theta.shape[0], theta.shape[1] + 1
+    products = np.cumprod(np.column_stack((np.ones(n), np.cos(theta))), axis=1)
+    F = np.empty((n, m))
+    for i in range(m):
+        F[:, i] = products[:, m - 1 - i]
+        if i > 0:
+            F[:, i] *= np.sin(theta[:, m - 1 - i])
+    return F * scale[:, None]
+
+
+def dtlz_rastrigin_g(Xm):
+    return 100 * (Xm.shape[1] + ((Xm - 0.5) ** 2 - np.cos(20 * np.pi * (Xm - 0.5))).sum(axis=1))
+
+
+def dtlz1(X, objectives=3):
+    g = dtlz_rastrigin_g(X[:, objectives - 1:])
+    return linear_front(X[:, :objectives - 1], 0.5 * (1 + g))
+
+
+def dtlz2(X, objectives=3):
+    g = ((X[:, objectives - 1:] - 0.5) ** 2).sum(axis=1)
+    return spherical_front(X[:, :objectives - 1] * np.pi / 2, 1 + g)
+
+
+def dtlz3(X, objectives=3):
+    g = dtlz_rastrigin_g(X[:, objectives - 1:])
+    return spherical_front(X[:, :objectives - 1] * np.pi / 2, 1 + g)
+
+
+def dtlz4(X, objectives=3, alpha=100):
+    g = ((X[:, objectives - 1:] - 0.5) ** 2).sum(axis=1)
+    return spherical_front(X[:, :objectives - 1] ** alpha * np.pi / 2, 1 + g)
+
+
+def dtlz5_theta(X, objectives, g):
+    theta = np.pi / (4 * (1 + g[:, None])) * (1 + 2 * g[:, None] * X[:, :objectives - 1])
+    theta[:, 0] = X[:, 0] * np.pi / 2
+    return theta
+
+
+def dtlz5(X, objectives=3):
+    g = ((X[:, objectives - 1:] - 0.5) ** 2).sum(axis=1)
+    return spherical_front(dtlz5_theta(X, objectives, g), 1 + g)
+
+
+def dtlz6(X, objectives=3):
+    g = (X[:, objectives - 1:] ** 0.1).sum(axis=1)
+    return spherical_front(dtlz5_theta(X, objectives, g), 1 + g)
+
+
+def dtlz7(X, objectives=3):
+    F = np.empty((X.shape[0], objectives))
+    F[:, :-1] = X[:, :objectives - 1]
+    g = 1 + 9 * X[:, objectives - 1:].mean(axis=1)
+    h = objectives - (F[:, :-1] / (1 + g[:, None]) * (1 + np.sin(3 * np.pi * F[:, :-1]))).sum(axis=1)
+    F[:, -1] = (1 + g) * h
+    return F
+
+
+def kur_batch(X):
+    f0 = (-10 * np.exp(-0.2 * np.sqrt(X[:, :-1] ** 2 + X[:, 1:] ** 2))).sum(axis=1)
+    f1 = (np.abs(X) ** 0.8 + 5 * np.sin(X ** 3)).sum(axis=1)
+    return np.column_stack((f0, f1))
+
+
+# name: (function, lower bound, upper bound, takes a number of objectives)
+test_problems = {
+    'zdt1': (zdt1, 0., 1., False),
+    'zdt2': (zdt2, 0., 1., False),
+    'zdt3': (zdt3, 0., 1., False),
+    'zdt4': (zdt4, -5., 5., False),
+    'zdt5': (zdt5, 0., 1., False),
+    'zdt6': (zdt6, 0., 1., False),
+    'dtlz1': (dtlz1, 0., 1., True),
+    'dtlz2': (dtlz2, 0., 1., True),
+    'dtlz3': (dtlz3, 0., 1., True),
+    'dtlz4': (dtlz4, 0., 1., True),
+    'dtlz5': (dtlz5, 0., 1., True),
+    'dtlz6': (dtlz6, 0., 1., True),
+    'dtlz7': (dtlz7, 0., 1., True),
+    'kur': (kur_batch, -5., 5., False),
+}
+
+# Default noise on measurements: a gaussian with this standard deviation relative to the
+# value, plus one with this absolute standard deviation
+RELATIVE_NOISE = 1 / 40
+ABSOLUTE_NOISE = 0.
+
+
+def problem_bounds(name, dimensions):
+    """
+    Lower and upper bounds of each parameter of a test problem
+    """
+    function, lower, upper, scalable = test_problems[name]
+    lower_bounds = np.full(dimensions, lower)
+    upper_bounds = np.full(dimensions, upper)
+    if name == 'zdt4':
+        lower_bounds[0], upper_bounds[0] = 0., 1.
+    return lower_bounds, upper_bounds
+
+
+def evaluate_population(name, X, objectives=3, relative_noise=0., absolute_noise=0.):
+    """
+    All of the objectives of a test problem for every row of X, in one call. DTLZ problems
+    have the given number of objectives. Gaussian noise is added to every value if requested.
+    """
+    function, lower, upper, scalable = test_problems[name]
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    F = function(X, objectives) if scalable else function(X)
+    if relative_noise or absolute_noise:
+        sigma = np.abs(F) * relative_noise + absolute_noise
+        F = F + np.random.standard_normal(F.shape) * sigma
+    return F
+
+
+# The objectives of the last test problem measured, so that the objectives of a point are
+# computed together rather than once per objective PV
+last_evaluation = [None, None]
+
+
+def problem_objectives(name, settings):
+    key = (name, tuple(settings))
+    if last_evaluation[0] != key:
+        last_evaluation[0] = key
+        last_evaluation[1] = evaluate_population(name, [settings])[0]
+    return last_evaluation[1]
+
+
 # Can consider h, i and j to be a group
 mach_mapping = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
 mach_setting = [8, 6, 4, 3, 6, 8, 2, 5.1, 4.8, 5]
 
-def lookup(pv):
+def resize(dimensions, value=0.5):
+    """
+    Change the number of simulated parameters, for test problems at other dimensions. New
+    parameters are named x<number> and start at value.
+    """
+    del mach_mapping[dimensions:]
+    del mach_setting[dimensions:]
+    for i in range(len(mach_mapping), dimensions):
+        mach_mapping.append('x{0}'.format(i))
+        mach_setting.append(value)
+
+
+def lookup(pv, settings=None):
+    if settings is None:
+        settings = mach_setting
     index = mach_mapping.index(pv)
-    return mach_setting[index]
+    return settings[index]
 
-def weighted_sum(weights):
+def weighted_sum(weights, settings=None):
+    if settings is None:
+        settings = mach_setting
     result = 0
 
-    for weight, value in zip(weights, mach_setting):
+    for weight, value in zip(weights, settings):
         result += weight * value
 
     return result
 
-def power_sum(weights, powers):
+def power_sum(weights, powers, settings=None):
+    if settings is None:
+        settings = mach_setting
     result = 0
 
-    for weight, power, value in zip(weights, powers, mach_setting):
+    for weight, power, value in zip(weights, powers, settings):
         result += weight * value ** power
 
     return result
 
-def caget(pv):
+def true_value(pv, settings):
+    """
+    The noise free value of pv with the machine in the given settings (a list in mach_mapping
+    order). This does not use the module state, so it can be called from several processes at
+    once.
+
+    A PV named <problem>:<n> is objective n of a test problem from test_problems, with every
+    setting as a parameter.
+    """
 
     result = None
 
+    def get(name):
+        return lookup(name, settings)
+
     if pv == 'r1':
-        result = weighted_sum([1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+        result = weighted_sum([1, 1, 1, 1, 1, 1, 1, 1, 1, 1], settings)
 
     elif pv == 'r2':
-        result = weighted_sum([-1, -2, -2, -1, -1, -1, -1, -4, -4, -4])
+        result = weighted_sum([-1, -2, -2, -1, -1, -1, -1, -4, -4, -4], settings)
 
     elif pv == 'r3':
-        result = weighted_sum([0, 0, 0, 0, 0, 0, 0, 4, 4, 4])
+        result = weighted_sum([0, 0, 0, 0, 0, 0, 0, 4, 4, 4], settings)
 
     elif pv == 'r4':
-        result = weighted_sum([0, 1, 0, 1, 0, 1, 0, 1, 0, 1])
+        result = weighted_sum([0, 1, 0, 1, 0, 1, 0, 1, 0, 1], settings)
 
     elif pv == 'r5':
-        result = power_sum([1]*10, [1, 0.2, 1.1, 2, 1.5, 2, 0.3, 1, 1, 1])
+        result = power_sum([1]*10, [1, 0.2, 1.1, 2, 1.5, 2, 0.3, 1, 1, 1], settings)
 
     elif pv == 'kur1':
-        result = kur([lookup('a'), lookup('b'), lookup('c')])[0]
+        result = problem_objectives('kur', [get('a'), get('b'), get('c')])[0]
 
     elif pv == 'kur2':
-        result = kur([lookup('a'), lookup('b'), lookup('c')])[1]
+        result = problem_objectives('kur', [get('a'), get('b'), get('c')])[1]
 
     elif pv == 'mkur1':
-        result = kur([lookup('a'), lookup('b'), lookup('c'), lookup('d'), lookup('e'), lookup('f'), lookup('g'), lookup('h')])[0]
+        result = kur([get('a'), get('b'), get('c'), get('d'), get('e'), get('f'), get('g'), get('h')])[0]
 
     elif pv == 'mkur2':
-        result = kur([lookup('a'), lookup('b'), lookup('c'), lookup('d'), lookup('e'), lookup('f'), lookup('g'), lookup('h')])[1]
+        result = kur([get('a'), get('b'), get('c'), get('d'), get('e'), get('f'), get('g'), get('h')])[1]
 
     elif pv == 'mat':
-        result = matFunc([lookup('a'), lookup('b')])
+        result = matFunc([get('a'), get('b')])
 
     elif pv in mach_mapping:
-        result = lookup(pv)
+        result = get(pv)
+
+    elif pv.split(':')[0] in test_problems:
+        name, objective = pv.split(':')
+        result = problem_objectives(name, settings)[int(objective)]
+
+    return result
+
+
+def measure(pv, settings):
+    """
+    Measure pv with the machine in the given settings: its true value with noise added, except
+    for the settings themselves
+    """
+    result = true_value(pv, settings)
+    if pv in mach_mapping:
         return result
 
-    result = random.normalvariate(result, result / 40)
-    check_string = "Current model state:\n"
-    for i, n in enumerate(mach_mapping):
-        check_string += "                    {0} : {1}\n\n".format(n, mach_setting[i])
-    #print check_string
+    result = random.normalvariate(result, abs(result) * RELATIVE_NOISE)
+    if ABSOLUTE_NOISE:
+        result += random.normalvariate(0, ABSOLUTE_NOISE)
     return result
 
 
+def caget(pv):
+    return measure(pv, mach_setting)
+
+
 def caput(pv, value):
     index = mach_mapping.index(pv)
     mach_setting[index] = value
-
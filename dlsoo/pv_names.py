@@ -0,0 +1,11 @@
+"""
+Names of the machine PVs used outside the optimisation parameters and objectives. This module
+imports nothing, so that tools such as the soft IOC can use the names without Tk or channel
+access.
+"""
+
+# PVs used to control injection
+INJECTION_START_PV = 'LI-TI-MTGEN-01:START'
+INJECTION_STOP_PV = 'LI-TI-MTGEN-01:STOP'
+# The DCCT
+BEAM_CURRENT_PV = 'SR-DI-DCCT-01:SIGNAL'
@@ -0,0 +1,183 @@
+"""
+Recording of channel access traffic to a compact binary trace, and an index of a trace by
+machine parameter setting for the replay interactor.
+
+A trace is a sequence of fixed size records. The first time a PV appears a NAME record gives
+its name; every later record refers to the PV by number. All timestamps are taken from the
+local clock (time.time()) when the operation completes, so that durations within a trace are
+not thrown off by the offset between the IOC and local clocks.
+"""
+import struct
+import time
+
+import numpy as np
+
+
+# Record kinds
+NAME = 0
+PUT = 1
+GET = 2
+MONITOR = 3
+
+# kind, PV number, local timestamp (s), latency (s), value
+RECORD = struct.Struct('<BHdfd')
+# kind, PV number, length of the name that follows
+NAME_RECORD = struct.Struct('<BHH')
+
+
+class trace_writer:
+    """
+    Appends channel access operations to a trace file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.pv_numbers = {}
+
+    def pv_number(self, pv):
+        if pv not in self.pv_numbers:
+            number = len(self.pv_numbers)
+            self.pv_numbers[pv] = number
+            self.file.write(NAME_RECORD.pack(NAME, number, len(pv)) + pv)
+        return self.pv_numbers[pv]
+
+    def write(self, kind, pv, value, timestamp, latency):
+        self.file.write(RECORD.pack(kind, self.pv_number(pv), timestamp, latency, value))
+        # Flush after parameters are set, so a trace is usable even if the run is killed
+        if kind == PUT:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(filename):
+    """
+    Yields (kind, pv, value, timestamp, latency) for every operation in a trace file. A trace
+    whose last record was cut short (e.g. the run was killed mid write) ends at the last
+    complete record.
+    """
+    names = {}
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    offset = 0
+    while offset < len(data):
+        kind = ord(data[offset])
+        if kind == NAME:
+            if offset + NAME_RECORD.size > len(data):
+                break
+            kind, number, length = NAME_RECORD.unpack_from(data, offset)
+            if offset + NAME_RECORD.size + length > len(data):
+                break
+            offset += NAME_RECORD.size
+            names[number] = data[offset:offset + length]
+            offset += length
+        else:
+            if offset + RECORD.size > len(data):
+                break
+            kind, number, timestamp, latency, value = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            yield kind, names[number], value, timestamp, latency
+
+
+# The trace being written, if recording
+writer = None
+
+
+def start(filename):
+    """
+    Record all channel access made through util to filename
+    """
+    global writer
+    stop()
+    writer = trace_writer(filename)
+    print('Recording channel access to {0}'.format(filename))
+
+
+def stop():
+    global writer
+    if writer is not None:
+        writer.close()
+        writer = None
+
+
+def record(kind, pvs, values, start_time=None, timestamps=None):
+    """
+    Record an operation on pvs, which started at start_time. Values that arrived earlier than
+    they are recorded (e.g. monitor updates) are given their local arrival times in timestamps;
+    the IOC timestamps of values are not used.
+    """
+    if writer is None:
+        return
+    now = time.time()
+    latency = now - start_time if start_time is not None else 0.
+    if timestamps is None:
+        timestamps = [now] * len(values)
+    for pv, value, timestamp in zip(pvs, values, timestamps):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            # Failed reads and non-numeric values are not replayable
+            continue
+        writer.write(kind, str(pv), value, timestamp, latency)
+
+
+class trace_index:
+    """
+    The samples of each measurement PV in a trace, grouped by the parameter setting they were
+    taken at. A setting is the full machine setting: the last value put to (or, before any
+    puts, read from) every parameter PV, whichever of them were written in the latest step.
+    """
+
+    def __init__(self, filename, param_pvs, measurement_pvs):
+        self.param_pvs = [str(pv) for pv in param_pvs]
+        measurement_pvs = set(str(pv) for pv in measurement_pvs)
+
+        settings = {}
+        self.initial_settings = None
+        # setting -> {pv: [samples]}, and setting -> time (s) spent measuring it
+        self.points = {}
+        self.durations = {}
+        set_time = None
+
+        for kind, pv, value, timestamp, latency in read_trace(filename):
+            if pv in self.param_pvs:
+                if kind == PUT:
+                    settings[pv] = value
+                    set_time = timestamp - latency
+                elif pv not in settings:
+                    settings[pv] = value
+                if self.initial_settings is None and len(settings) == len(self.param_pvs):
+                    self.initial_settings = tuple(settings[p] for p in self.param_pvs)
+                continue
+
+            if pv not in measurement_pvs or len(settings) < len(self.param_pvs):
+                continue
+            setting = tuple(settings[p] for p in self.param_pvs)
+            self.points.setdefault(setting, {}).setdefault(pv, []).append(value)
+            if set_time is not None:
+                self.durations[setting] = max(self.durations.get(setting, 0.), timestamp - set_time)
+
+        self.settings = list(self.points)
+        self.settings_array = np.array(self.settings, dtype=float).reshape(len(self.settings), -1)
+        # Parameters are compared in units of their range over the trace
+        scale = np.ptp(self.settings_array, axis=0) if self.settings else np.ones(len(self.param_pvs))
+        scale[scale == 0] = 1.
+        self.scale = scale
+
+    def nearest(self, setting, tolerances=None):
+        """
+        The recorded setting equal to setting, or else the nearest one to it. Returns the
+        recorded setting and whether it matched: exactly, or with every parameter within its
+        tolerance if tolerances are given.
+        """
+        setting = tuple(float(value) for value in setting)
+        if setting in self.points:
+            return setting, True
+        distances = np.sum(((self.settings_array - setting) / self.scale) ** 2, axis=1)
+        index = int(np.argmin(distances))
+        matched = (tolerances is not None and
+                   np.all(np.abs(self.settings_array[index] - setting) <= np.asarray(tolerances, dtype=float)))
+        return self.settings[index], bool(matched)
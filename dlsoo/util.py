@@ -1,15 +1,75 @@
 from __future__ import division
 
 
-import time
+import collections
 import math
+import sys
+import time
 import pickle
+import numpy as np
 import ca_abstraction_mapping
+import recording
 
-from cothread.catools import caget, caput
+from cothread.catools import caget, caput, camonitor, connect, ca_nothing, FORMAT_TIME
 import cothread
 
 
+# Time allowed (s) for the initial connection to all PVs
+CONNECT_TIMEOUT = 5.0
+# Time allowed (s) for a caget or caput of a PV with no timeout of its own
+CA_TIMEOUT = 2.0
+# Number of times a failed caget or caput is retried, and the pause (s) before the
+# first retry. The pause doubles for every further retry.
+CA_RETRIES = 2
+CA_BACKOFF = 0.5
+
+# What to do with a candidate whose measurement fails even after the retries: measure
+# it again (up to REMEASURE_ATTEMPTS more times) or straight away mark it as failed.
+REMEASURE = 'remeasure'
+MARK_FAILED = 'mark failed'
+FAILURE_POLICY = REMEASURE
+REMEASURE_ATTEMPTS = 1
+
+# Timeouts of individual PVs (see set_timeouts) and their health, keyed by PV name
+pv_timeouts = {}
+pv_health = {}
+
+# Number of monitor updates kept for each streamed PV
+STREAM_BUFFER_SIZE = 1000
+# Extra time allowed (s) for a streamed PV to deliver its samples
+STREAM_TIMEOUT = 5.0
+
+# Open monitor buffers, keyed by PV name
+monitor_buffers = {}
+
+# Samples further than this many standard deviations from the centre are outliers
+OUTLIER_SIGMA = 2.0
+# Maximum number of sigma clipping passes
+OUTLIER_ITERATIONS = 5
+# Converts a median absolute deviation into a standard deviation for normal noise
+MAD_SCALE = 1.4826
+# Sample limit for objectives with a target error but no max_counts
+ADAPTIVE_MAX_COUNTS = 100
+
+# A timestamped PV that has not updated for this long (s) is assumed to be static, and its
+# repeated value is accepted as a new sample for the rest of the measurement
+STALE_TIMEOUT = 10.0
+# Auto paced objectives poll this fraction of an update period after the next
+# update is due, and this fraction of a period after reading a stale value
+PACE_MARGIN = 0.05
+STALE_POLL = 0.1
+
+# Shortest observed update period (s) of each timestamped PV
+update_periods = {}
+# When (local clock) the parameters last settled after set_params. Timestamped samples taken
+# before it are stale.
+last_set_time = None
+# Smallest seen difference (s) between the local time a value of each timestamped PV arrived and
+# its EPICS timestamp: the offset of the IOC clock from ours plus the shortest read latency. An
+# EPICS timestamp plus this is (at the latest) when the value was taken, by our clock.
+clock_offsets = {}
+
+
 def extract_column(matrix, colnum):
     col = []
     for i in matrix:
@@ -43,51 +103,594 @@ def save_object(obj, filename):
         pickle.dump(obj, output)
 
 
-def abstract_caget(pv, throw=False):
+class BulkCaError(Exception):
+    """
+    Raised when any of the PVs in a bulk caget or caput fail. Every failure is reported together.
+    """
+
+    def __init__(self, operation, failures):
+        self.operation = operation
+        self.failures = failures
+        Exception.__init__(self, '{0} failed for {1} PV(s):\n{2}'.format(
+            operation, len(failures), '\n'.join(str(failure) for failure in failures)))
+
+
+class health_record:
+    """
+    Latency and failure history of channel access to a single PV
+    """
+
+    def __init__(self, pv):
+        self.pv = pv
+        self.calls = 0
+        self.failures = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.last_good = None
+
+    def record(self, latency, ok):
+        self.calls += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if ok:
+            self.last_good = time.time()
+        else:
+            self.failures += 1
+
+    def mean_latency(self):
+        return self.total_latency / self.calls if self.calls else 0.
+
+
+def set_timeouts(variables):
     """
-    standard channel access 'get' function using cothread
+    register the timeouts of any parameter or measurement variables that have their own
+    """
+    for variable in variables:
+        if variable.timeout is not None:
+            pv_timeouts[str(variable.pv)] = variable.timeout
+
+
+def retry_ca(operation, pvs, request):
+    """
+    Make a channel access request for a list of PVs, retrying any that fail. request is called
+    with the indices of the PVs still to do and a timeout, and must return a result with an .ok
+    field for each of them (as cothread does with throw=False). Every attempt is recorded in
+    pv_health. The results are returned in PV order, or a BulkCaError is raised for the PVs that
+    still fail after CA_RETRIES retries.
+    """
+    if not pvs:
+        return []
+
+    results = [None] * len(pvs)
+    remaining = range(len(pvs))
+    pause = CA_BACKOFF
+    for attempt in range(CA_RETRIES + 1):
+        timeout = max(pv_timeouts.get(pvs[i], CA_TIMEOUT) for i in remaining)
+        start_time = time.time()
+        replies = request(remaining, timeout)
+        latency = time.time() - start_time
+
+        failed = []
+        for i, reply in zip(remaining, replies):
+            if pvs[i] not in pv_health:
+                pv_health[pvs[i]] = health_record(pvs[i])
+            pv_health[pvs[i]].record(latency, reply.ok)
+            results[i] = reply
+            if not reply.ok:
+                failed.append(i)
+
+        remaining = failed
+        if not remaining:
+            return results
+        if attempt < CA_RETRIES:
+            print('{0} failed for {1}, retrying in {2} s'.format(
+                operation, [pvs[i] for i in remaining], pause))
+            cothread.Sleep(pause)
+            pause *= 2
+
+    raise BulkCaError(operation, [results[i] for i in remaining])
+
+
+def health_report():
+    """
+    returns a table of the channel access health of every PV used, slowest first
+    """
+    report = "{0:<40} {1:>7} {2:>8} {3:>12} {4:>11}  {5}\n".format(
+        "PV", "Calls", "Failures", "Mean lat./s", "Max lat./s", "Last good")
+    for record in sorted(pv_health.values(), key=lambda record: -record.mean_latency()):
+        if record.last_good is None:
+            last_good = "never"
+        else:
+            last_good = time.strftime('%H:%M:%S', time.localtime(record.last_good))
+        report += "{0:<40} {1:>7} {2:>8} {3:>12.4f} {4:>11.4f}  {5}\n".format(
+            record.pv, record.calls, record.failures, record.mean_latency(),
+            record.max_latency, last_good)
+
+    return report
+
+
+def abstract_caget(pv, throw=False, timestamped=False):
+    """
+    standard channel access 'get' function using cothread, with a bounded timeout and retries.
+    If timestamped is True the value also carries its EPICS timestamp (as .timestamp).
     """
-    print('caget {}'.format(pv))
     # Ensure cothread can handle the PV - unicode strings can be misunderstood
     pv = str(pv)
+    start = time.time()
     if pv in ca_abstraction_mapping.name_to_function_mapping:
-        return ca_abstraction_mapping.name_to_function_mapping[pv]()
+        value = ca_abstraction_mapping.name_to_function_mapping[pv]()
     else:
-        return caget(pv, throw=True)
+        kargs = {'format': FORMAT_TIME} if timestamped else {}
+        value = retry_ca('caget', [pv], lambda indices, timeout: caget(
+            [pv], timeout=timeout, throw=False, **kargs))[0]
+    recording.record(recording.GET, [pv], [value], start)
+    return value
+
+
+def abstract_caget_stamped(pv):
+    """
+    abstract_caget returning timestamped values, for use as a measure_results get_command
+    """
+    return abstract_caget(pv, timestamped=True)
 
 
 def abstract_caput(pv, value):
     """
-    standard channel access 'set' function using cothread
+    standard channel access 'set' function using cothread, with a bounded timeout and retries
     """
-    caput(pv, value)
+    pv = str(pv)
+    start = time.time()
+    retry_ca('caput', [pv], lambda indices, timeout: caput(
+        [pv], [value], timeout=timeout, throw=False))
+    recording.record(recording.PUT, [pv], [value], start)
+
+
+def connect_pvs(pvs, timeout=CONNECT_TIMEOUT):
+    """
+    Connect to all of the PVs in parallel. cothread keeps the channels open for the rest of the
+    run, so later cagets and caputs do not pay the connection time. Derived objectives are
+    replaced by the raw PVs they read. Every PV that cannot be reached is reported together in
+    one BulkCaError.
+    """
+    pvs = [str(pv) for pv in pvs]
+    derived = [pv for pv in pvs if pv in ca_abstraction_mapping.derived_objectives]
+    pvs = sorted(set(pv for pv in pvs if pv not in ca_abstraction_mapping.name_to_function_mapping) |
+                 set(ca_abstraction_mapping.raw_pvs(derived)))
+    statuses = connect(pvs, timeout=timeout, throw=False)
+    failures = [status for status in statuses if not status.ok]
+    if failures:
+        raise BulkCaError('connect', failures)
+
+    print('Connected to {0} PVs'.format(len(pvs)))
+
+
+def abstract_caget_list(pvs):
+    """
+    channel access 'get' for a list of PVs. All of the requests are made by a single cothread
+    caget so they are in flight at the same time.
+    """
+    pvs = [str(pv) for pv in pvs]
+    start = time.time()
+    raw_pvs = [pv for pv in pvs if pv not in ca_abstraction_mapping.name_to_function_mapping]
+
+    raw_values = retry_ca('caget', raw_pvs, lambda indices, timeout: caget(
+        [raw_pvs[i] for i in indices], timeout=timeout, throw=False))
+    raw_values = dict(zip(raw_pvs, raw_values))
+
+    values = []
+    for pv in pvs:
+        if pv in raw_values:
+            values.append(raw_values[pv])
+        else:
+            values.append(ca_abstraction_mapping.name_to_function_mapping[pv]())
 
+    recording.record(recording.GET, pvs, values, start)
+    return values
 
-def set_params(param_vars, settings, set_command):
+
+def abstract_caput_list(pvs, values):
+    """
+    channel access 'set' for a list of PVs. The puts are issued together and waited on once.
     """
-    change the parameters using set_command. This will usually be abstract_caput
+    pvs = [str(pv) for pv in pvs]
+    start = time.time()
+    retry_ca('caput', pvs, lambda indices, timeout: caput(
+        [pvs[i] for i in indices], [values[i] for i in indices], wait=True, timeout=timeout,
+        throw=False))
+    recording.record(recording.PUT, pvs, values, start)
+
+
+def measure_with_policy(measure, measurement_vars):
     """
+    Call measure (which returns a list of measurements) and apply the FAILURE_POLICY if a PV
+    cannot be read. With REMEASURE the candidate is measured again, up to REMEASURE_ATTEMPTS
+    times. If it still fails, or with MARK_FAILED, every objective is returned as a failed
+    measurement with an infinite mean so the algorithms treat the candidate as the worst possible.
+    """
+    attempts = 1
+    if FAILURE_POLICY == REMEASURE:
+        attempts += REMEASURE_ATTEMPTS
+
+    for attempt in range(attempts):
+        try:
+            return measure()
+        except (BulkCaError, ca_nothing) as e:
+            print('Measurement {0} of {1} failed: {2}'.format(attempt + 1, attempts, e))
+
+    return [measurement(mean=float('inf'), dev=float('inf'), counts=0, err=float('inf'),
+                        failed=True)
+            for measurement_var in measurement_vars]
+
+
+class monitor_buffer:
+    """
+    Ring buffer fed by a camonitor subscription to a single PV.
+    """
+
+    def __init__(self, pv, size=STREAM_BUFFER_SIZE):
+        self.pv = pv
+        self.buffer = collections.deque(maxlen=size)
+        self.updated = cothread.Event()
+        self.subscription = camonitor(pv, self.on_update)
+
+    def on_update(self, value):
+        # Arrival times are kept for the trace, which uses the local clock throughout
+        self.buffer.append((time.time(), value))
+        self.updated.Signal()
+
+    def drain(self, counts, timeout, discard=True):
+        """
+        Wait for the next counts updates of the PV and return them. Unless discard is False,
+        anything already in the buffer predates the request (e.g. it arrived while the parameters
+        were settling) and is thrown away. Fewer than counts values are returned if the timeout
+        expires.
+        """
+        if discard:
+            self.buffer.clear()
+            self.updated.Reset()
+        deadline = cothread.AbsTimeout(timeout)
+        while len(self.buffer) < counts:
+            try:
+                self.updated.Wait(deadline)
+            except cothread.Timedout:
+                break
+
+        updates = [self.buffer.popleft() for i in range(min(counts, len(self.buffer)))]
+        values = [value for arrived, value in updates]
+        recording.record(recording.MONITOR, [self.pv] * len(values), values,
+                         timestamps=[arrived for arrived, value in updates])
+        return values
+
+    def close(self):
+        self.subscription.close()
+
+
+def stream_samples(measurement_var):
+    """
+    Collect min_counts fresh samples of an objective from its monitor buffer, opening the
+    subscription on first use. If the PV does not update often enough the remaining samples
+    are taken with abstract_caget.
+    """
+    pv = str(measurement_var.pv)
+    if pv not in monitor_buffers:
+        monitor_buffers[pv] = monitor_buffer(pv)
+
+    counts = int(measurement_var.min_counts)
+    timeout = STREAM_TIMEOUT + counts * measurement_var.delay
+    samples = monitor_buffers[pv].drain(counts, timeout)
+
+    if len(samples) < counts:
+        print('{0} only streamed {1} of {2} samples, polling for the rest'.format(pv, len(samples), counts))
+        while len(samples) < counts:
+            samples.append(abstract_caget(pv))
+            cothread.Sleep(measurement_var.delay)
+
+    statistics = running_statistics()
+    statistics.add_array(samples)
+    while not enough_samples(measurement_var, statistics):
+        more = monitor_buffers[pv].drain(1, STREAM_TIMEOUT + measurement_var.delay, discard=False)
+        if not more:
+            more = [abstract_caget(pv)]
+        samples.extend(more)
+        statistics.add_array(more)
+
+    return samples
+
+
+def close_streams():
+    """
+    close all of the monitor subscriptions opened by stream_samples
+    """
+    for buffer in monitor_buffers.values():
+        buffer.close()
+    monitor_buffers.clear()
+
+
+def wait_for_readbacks(param_vars, settings, timeout):
+    """
+    Wait, using monitors on the readback PVs, until every parameter's readback is within its
+    tolerance of the value it was set to. Returns False if this does not happen within timeout.
+    """
+    readback_pvs = [str(param.readback_pv) for param in param_vars]
+    tolerances = [param.tolerance or 0. for param in param_vars]
+    in_tolerance = [False] * len(param_vars)
+    settled = cothread.Event(auto_reset=False)
+
+    def check_readback(value, index):
+        in_tolerance[index] = abs(value - settings[index]) <= tolerances[index]
+        if all(in_tolerance):
+            settled.Signal()
+
+    subscriptions = camonitor(readback_pvs, check_readback)
+    try:
+        settled.Wait(timeout)
+        return True
+    except cothread.Timedout:
+        not_settled = [pv for pv, ok in zip(readback_pvs, in_tolerance) if not ok]
+        print('Readbacks not settled after {0} s: {1}'.format(timeout, not_settled))
+        return False
+    finally:
+        for subscription in subscriptions:
+            subscription.close()
+
+
+def changed_params(param_vars, last_settings, settings):
+    """
+    Return the indices of the parameters whose new setting differs from the last one written by
+    more than their dead band. If the last settings are not known, every parameter has changed.
+    """
+    if last_settings is None:
+        return range(len(param_vars))
+
+    changed = []
+    for i in range(len(param_vars)):
+        if abs(settings[i] - last_settings[i]) > param_vars[i].dead_band:
+            changed.append(i)
+
+    return changed
+
+
+def set_params(param_vars, settings, set_command, bulk=False, settle_command=None):
+    """
+    change the parameters using set_command. This will usually be abstract_caput, or
+    abstract_caput_list if bulk is True (in which case all of the PVs are set in one call)
+
+    If a settle_command is given (usually wait_for_readbacks), parameters that have a readback
+    PV are waited on until they settle, with their delay only as the upper bound.
+    """
+    if not param_vars:
+        return
+
+    # Split the parameters into those we can watch settle and those we just wait for
+    if settle_command is not None:
+        watched = [i for i in range(len(param_vars)) if param_vars[i].readback_pv]
+    else:
+        watched = []
+    unwatched = [i for i in range(len(param_vars)) if i not in watched]
 
     # Calculate the maximum delay time
     max_delay = 0
-    for i in param_vars:
-        if i.delay > max_delay:
-            max_delay = i.delay
+    for i in unwatched:
+        if param_vars[i].delay > max_delay:
+            max_delay = param_vars[i].delay
 
     # Set the parameters
-    for i in range(len(param_vars)):
-        set_command(param_vars[i].pv, settings[i])
+    global last_set_time
+    start_time = time.time()
+    # No derived objective may be given raw PVs read at the previous setting
+    ca_abstraction_mapping.clear_snapshot()
+    if bulk:
+        set_command([param.pv for param in param_vars], settings)
+    else:
+        for i in range(len(param_vars)):
+            set_command(param_vars[i].pv, settings[i])
+
+    # Wait for the readbacks, but no longer than the slowest of their delays
+    if watched:
+        settle_command([param_vars[i] for i in watched], [settings[i] for i in watched],
+                       max(param_vars[i].delay for i in watched))
 
     # Sleep for the appropriate amount of time
-    cothread.Sleep(max_delay)
+    cothread.Sleep(max(0, max_delay - (time.time() - start_time)))
 
+    # Values that updated while the parameters were settling are not of the new setting
+    last_set_time = time.time()
 
-def measure_results(measurement_vars, get_command):
+
+class running_statistics:
+    """
+    Numerically stable single pass mean and variance (Welford). Values can be added one at a
+    time, or a whole array can be merged in at once.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def add_array(self, values):
+        values = np.asarray(values, dtype=float)
+        count = len(values)
+        if count == 0:
+            return
+
+        # Merge the moments of the array with the running ones (Chan et al.)
+        array_mean = float(values.mean())
+        array_m2 = float(np.square(values - array_mean).sum())
+        total = self.count + count
+        delta = array_mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += array_m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def variance(self):
+        if self.count == 0:
+            return 0.
+        return self.m2 / self.count
+
+    def deviation(self):
+        return math.sqrt(self.variance())
+
+    def error(self):
+        if self.count == 0:
+            return float('inf')
+        return self.deviation() / math.sqrt(self.count)
+
+
+def clipped_statistics(samples, nsigma=OUTLIER_SIGMA, robust=False, max_iterations=OUTLIER_ITERATIONS):
+    """
+    Repeatedly discard samples more than nsigma standard deviations from the mean until none
+    are left to discard, then return the running_statistics of the remaining samples. If robust
+    is True the median and the median absolute deviation are used to find the outliers instead.
+    """
+    values = np.asarray(samples, dtype=float)
+    keep = np.ones(len(values), dtype=bool)
+
+    for iteration in range(max_iterations):
+        kept = values[keep]
+        if len(kept) == 0:
+            break
+        if robust:
+            centre = np.median(kept)
+            scale = MAD_SCALE * np.median(np.abs(kept - centre))
+        else:
+            centre = kept.mean()
+            scale = kept.std()
+        if scale == 0:
+            break
+
+        new_keep = keep & (np.abs(values - centre) <= nsigma * scale)
+        if new_keep.sum() == keep.sum():
+            break
+        keep = new_keep
+
+    statistics = running_statistics()
+    statistics.add_array(values[keep])
+    return statistics
+
+
+def enough_samples(measurement_var, statistics):
+    """
+    Decide whether an objective has been sampled enough. Without a target error this is after
+    min_counts samples. Otherwise sampling continues until the standard error of the samples so
+    far is within the target, or max_counts samples have been taken.
+    """
+    if statistics.count < int(measurement_var.min_counts):
+        return False
+    if measurement_var.target_err is None:
+        return True
+
+    max_counts = measurement_var.max_counts
+    if max_counts is None:
+        max_counts = ADAPTIVE_MAX_COUNTS
+    if statistics.count >= int(max_counts):
+        return True
+
+    return statistics.count > 1 and statistics.error() <= measurement_var.target_err
+
+
+def poll_delay(measurement_var, last_timestamp, stale):
+    """
+    Time to wait before polling an objective again. This is its delay, unless it is auto paced
+    and the update period of its PV is known, in which case the next poll is timed for just
+    after the next update is due.
+    """
+    period = update_periods.get(str(measurement_var.pv))
+    if not measurement_var.auto_pace or period is None or last_timestamp is None:
+        return measurement_var.delay
+    if stale:
+        return STALE_POLL * period
+
+    # The offset of the IOC clock from ours is only estimated, so never wait more than a period
+    offset = clock_offsets.get(str(measurement_var.pv), 0.)
+    due = last_timestamp + offset + period * (1 + PACE_MARGIN) - time.time()
+    return min(period, max(0., due))
+
+
+def sample_measurement_var(measurement_var, get_command):
+    """
+    Sample a single objective until enough_samples is satisfied. The delay between samples is a
+    cothread sleep, so other objectives (and the GUI) keep running while this one waits.
+
+    If get_command returns values with EPICS timestamps (e.g. abstract_caget_stamped), a value
+    is only accepted if it was taken after the parameters last settled and once its timestamp
+    has advanced, so neither a pre-settle value nor the same update is counted. Timestamps are
+    compared with each other in the IOC clock, and with the settle time through the estimated
+    offset of the IOC clock (clock_offsets). Before the offset of a PV is known, the first
+    value read only sets the timestamp the next one must be newer than. Objectives with check_timestamps off accept every
+    value.
+    """
+    pv = str(measurement_var.pv)
+    statistics = running_statistics()
+    samples = []
+    check_timestamps = measurement_var.check_timestamps
+    last_timestamp = None
+    # Timestamp (IOC clock) a value must be newer than when there is no accepted one to compare
+    # with, if the offset of the IOC clock is not known
+    unknown_offset_floor = None
+    last_accepted = time.time()
+    while True:
+        value = get_command(measurement_var.pv)
+        arrived = time.time()
+        timestamp = getattr(value, 'timestamp', None) if check_timestamps else None
+
+        if timestamp is None:
+            stale = False
+        elif last_timestamp is not None:
+            stale = timestamp <= last_timestamp
+        elif last_set_time is None:
+            stale = False
+        elif unknown_offset_floor is not None:
+            stale = timestamp <= unknown_offset_floor
+        elif pv in clock_offsets:
+            stale = timestamp + clock_offsets[pv] < last_set_time
+        else:
+            # Nothing is known of the IOC clock yet, so only an update after this read is
+            # certain to be fresh
+            unknown_offset_floor = timestamp
+            stale = True
+        if timestamp is not None:
+            clock_offsets[pv] = min(clock_offsets.get(pv, float('inf')), arrived - timestamp)
+        if stale and time.time() - last_accepted > STALE_TIMEOUT:
+            print('{0} has not updated for {1} s, accepting its values without checking their '
+                  'timestamps'.format(pv, STALE_TIMEOUT))
+            check_timestamps = False
+            stale = False
+
+        if not stale:
+            if timestamp is not None and last_timestamp is not None:
+                update_periods[pv] = min(update_periods.get(pv, float('inf')),
+                                         timestamp - last_timestamp)
+            samples.append(value)
+            statistics.add(value)
+            last_timestamp = timestamp
+            last_accepted = time.time()
+            if enough_samples(measurement_var, statistics):
+                break
+
+        cothread.Sleep(poll_delay(measurement_var, last_timestamp, stale))
+
+    return samples
+
+
+def measure_results(measurement_vars, get_command, stream_command=None):
     """
     This part (redesigned by @James Rogers) measures the objectives and calculates the mean and standard deviation.
-    Outliers are detected (2*sigma away from mean) and discarded. The mean and standard deviation are then returned.
+    Outliers are detected (2*sigma away from mean) and discarded by clipped_statistics. The mean and standard
+    deviation are then returned.
 
-    The get_command is usually abstract_caget (see above).
+    Every objective is sampled concurrently on its own cothread, so the time taken is that of the
+    slowest objective rather than the sum over all of them.
+
+    The get_command is usually abstract_caget (see above). If a stream_command is given (usually
+    stream_samples), objectives marked as streaming are read from their monitors instead. Derived
+    objectives from ca_abstraction_mapping are always polled.
     """
 
     average = []
@@ -95,51 +698,42 @@ def measure_results(measurement_vars, get_command):
     dev = []
     err = []
 
+    #sample all of the objectives at the same time
+    tasks = []
+    for measurement_var in measurement_vars:
+        if (stream_command is not None and measurement_var.streaming and
+                measurement_var.pv not in ca_abstraction_mapping.name_to_function_mapping):
+            tasks.append(cothread.Spawn(stream_command, measurement_var, raise_on_wait=True))
+        else:
+            tasks.append(cothread.Spawn(sample_measurement_var, measurement_var, get_command,
+                                        raise_on_wait=True))
+    # Every task is waited for even if one fails, so none is left sampling while the failure
+    # policy measures the point again. The first failure is then raised.
+    all_samples = []
+    failure = None
+    for task in tasks:
+        try:
+            all_samples.append(task.Wait())
+        except Exception:
+            if failure is None:
+                failure = sys.exc_info()
+    if failure is not None:
+        raise failure[0], failure[1], failure[2]
+
     #for each objective
     for i in range(len(measurement_vars)):
 
-        result = int(measurement_vars[i].min_counts) * [0.]
         print(measurement_vars[i].min_counts), "min counts"
-        std = int(measurement_vars[i].min_counts) * [0.]
-        #print result
-        for j in range(int(measurement_vars[i].min_counts)):
-
-            value = get_command(measurement_vars[i].pv)
-            result[j] = value
-            std[j] = value ** 2
-            #j += 1   #???
-            time.sleep(measurement_vars[i].delay)
-
-        mean = sum(result) / measurement_vars[i].min_counts
-        standard_deviation = (sum(std) / measurement_vars[i].min_counts) - mean ** 2
-        standard_deviation = math.sqrt(standard_deviation)
 
         #detect and remove any outliers
-        anomaly = False
-        for j in result:
-            if (abs(mean - j)) > 2 * standard_deviation:
-                anomaly = True
-                index = result.index(j)
-                result.remove(j)
-                del std[index]
-
-        #recalculate mean if outliers are found
-        if anomaly == True:
-            mean = sum(result) / len(result)
-            standard_deviation = (sum(std) / len(result)) - mean ** 2
-            standard_deviation = math.sqrt(standard_deviation)
-
-
-        stat_err = standard_deviation / math.sqrt(len(result))
-        print(stat_err), "util stat_err "
-        print(standard_deviation), "util stand_div "
-        average.append(mean)
-        counts.append(len(result))
-        dev.append(standard_deviation)
-        err.append(stat_err)
-
-
+        statistics = clipped_statistics(all_samples[i], robust=measurement_vars[i].robust)
 
+        print(statistics.error()), "util stat_err "
+        print(statistics.deviation()), "util stand_div "
+        average.append(statistics.mean)
+        counts.append(statistics.count)
+        dev.append(statistics.deviation())
+        err.append(statistics.error())
 
     results = []
     for i in range(len(average)):
@@ -151,6 +745,71 @@ def measure_results(measurement_vars, get_command):
 
     return results
 
+def group_delays(param_var_groups):
+    """
+    the longest delay in each parameter group, used to weight moves of the algorithm parameters
+    """
+    return [max(param.delay for param in group) for group in param_var_groups]
+
+
+def order_by_travel(points, lower, upper, start=None, weights=None, max_passes=50):
+    """
+    Choose the order in which to visit a batch of points in algorithm parameter space so that
+    the machine moves as little as possible between consecutive points. Distances are measured
+    with each parameter normalised by its bounds and scaled by its weight. A nearest neighbour
+    path (from start, if given) is improved by 2-opt. Returns the indices of the points in the
+    order they should be visited.
+    """
+    n = len(points)
+    if n < 2:
+        return range(n)
+
+    lower = np.asarray(lower, dtype=float)
+    span = np.asarray(upper, dtype=float) - lower
+    span[span == 0] = 1.
+    if weights is None or not np.any(weights):
+        weights = np.ones(len(lower))
+    nodes = (np.asarray(points, dtype=float) - lower) / span * np.asarray(weights, dtype=float)
+
+    # Nodes 0..n-1 are the points. The path runs from a head node (the start point, or a
+    # dummy) to a dummy tail node; dummies are zero distance from everything.
+    if start is not None:
+        start = (np.asarray(start, dtype=float) - lower) / span * np.asarray(weights, dtype=float)
+        nodes = np.vstack([nodes, start])
+    size = len(nodes) + 2
+    distance = np.zeros((size, size))
+    distance[:len(nodes), :len(nodes)] = np.sqrt(
+        np.square(nodes[:, np.newaxis, :] - nodes[np.newaxis, :, :]).sum(axis=2))
+    head = n if start is not None else size - 2
+    tail = size - 1
+
+    # Nearest neighbour path
+    path = [head]
+    unvisited = range(n)
+    while unvisited:
+        nearest = int(np.argmin(distance[path[-1], unvisited]))
+        path.append(unvisited.pop(nearest))
+    path.append(tail)
+    path = np.array(path)
+
+    # 2-opt: reverse any section of the path that makes it shorter
+    for iteration in range(max_passes):
+        improved = False
+        for i in range(1, len(path) - 2):
+            before, first = path[i - 1], path[i]
+            last, after = path[i + 1:-1], path[i + 2:]
+            gain = (distance[before, first] + distance[last, after] -
+                    distance[before, last] - distance[first, after])
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-12:
+                path[i:i + j + 2] = path[i:i + j + 2][::-1].copy()
+                improved = True
+        if not improved:
+            break
+
+    return [int(node) for node in path[1:-1]]
+
+
 def find_group_a_bounds(param_var_min, param_var_max, initial_values, set_relative):
     '''
     This part (not finished) is to find the boundaries required for the algorithm parameters
@@ -219,6 +878,12 @@ def save_details_file(object):
     file_return += "-------------------\n"
     for i in object.param_vars:
         file_return += "PV name: {0}\n".format(i.pv)
+        if i.readback_pv:
+            file_return += "Readback PV: {0} (tolerance {1})\n".format(i.readback_pv, i.tolerance)
+        if i.cache_tolerance is not None:
+            file_return += "Cache tolerance: {0}\n".format(i.cache_tolerance)
+        if i.dead_band:
+            file_return += "Dead band: {0}\n".format(i.dead_band)
         file_return += "Delay: {0} s\n\n".format(i.delay)
 
     file_return += "Measurement variables:\n"
@@ -233,8 +898,21 @@ def save_details_file(object):
     for i in collated_measurement_vars:
         file_return += "PV name: {0}\n".format(i.pv)
         file_return += "Minimum counts: {0}\n".format(i.min_counts)
+        if i.target_err is not None:
+            file_return += "Target error: {0}\n".format(i.target_err)
+            file_return += "Maximum counts: {0}\n".format(i.max_counts)
         file_return += "Delay: {0} s\n\n".format(i.delay)
 
+    if getattr(object, "cache", None) is not None:
+        file_return += "Result cache:\n"
+        file_return += "------------\n"
+        file_return += object.cache.report() + "\n\n"
+
+    if pv_health:
+        file_return += "Channel access health:\n"
+        file_return += "---------------------\n"
+        file_return += health_report()
+
     return file_return
 
 #-----------------------------------------PARAMETER AND OBJECTIVE PYTHON OBJECTS USED IN MAIN.PY------------------------------------#
@@ -243,12 +921,16 @@ def save_details_file(object):
 
 class measurement:
 
-    def __init__(self, name=None, mean=None, dev=None, counts=None, err=None):
+    # True if the PVs could not be read (see measure_with_policy)
+    failed = False
+
+    def __init__(self, name=None, mean=None, dev=None, counts=None, err=None, failed=False):
         self.name = name
         self.mean = mean
         self.dev = dev
         self.counts = counts
         self.err = err
+        self.failed = failed
 
     def __neg__(self):
         result = self
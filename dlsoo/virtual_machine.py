@@ -0,0 +1,243 @@
+"""
+A virtual machine for testing the optimisers: the test problems of model.py behind the timing
+and imperfections of the real machine. Parameters settle towards their settings, channel
+access has latency, measurements have correlated noise, the machine drifts and the beam is
+occasionally lost. Everything runs in virtual time, so hours of machine time take seconds.
+"""
+from __future__ import division
+import heapq
+import math
+import numpy as np
+import cothread
+
+from . import model, util
+
+
+# Time constant (s) with which a parameter approaches a new setting
+SETTLE_TIME = 1.0
+# Channel access round trip times are lognormal with this median (s) and shape
+LATENCY_MEDIAN = 0.02
+LATENCY_SIGMA = 0.5
+# Relative standard deviation of measurement noise, and its correlation time (s)
+NOISE = 1 / 40
+NOISE_CORRELATION = 2.0
+# Standard deviation of the drift of every parameter after one hour
+DRIFT = 0.05
+# Mean time (s) between beam losses, and the time (s) to recover from one
+BEAM_LOSS_INTERVAL = 4 * 3600.
+BEAM_LOSS_DURATION = 120.
+
+
+class virtual_clock:
+    """
+    Virtual time (s). With a speedup, sleeping also waits in real time for the virtual time
+    divided by the speedup; otherwise it is instant.
+    """
+
+    def __init__(self, speedup=None):
+        self.time = 0.
+        self.speedup = speedup
+
+    def sleep(self, duration):
+        if duration <= 0:
+            return
+        self.time += duration
+        if self.speedup:
+            cothread.Sleep(duration / self.speedup)
+
+
+class virtual_machine:
+    """
+    The machine state. The parameters are those of model.mach_mapping, and measurements are
+    model.true_value of the parameters as they actually are (settling, and with drift) with
+    noise added. A measurement taken while the beam is lost is NaN.
+    """
+
+    def __init__(self,
+                 settle_times=None,
+                 latency_median=LATENCY_MEDIAN,
+                 latency_sigma=LATENCY_SIGMA,
+                 noise=NOISE,
+                 noise_correlation=NOISE_CORRELATION,
+                 drift=DRIFT,
+                 beam_loss_interval=BEAM_LOSS_INTERVAL,
+                 beam_loss_duration=BEAM_LOSS_DURATION,
+                 speedup=None,
+                 seed=None):
+
+        self.clock = virtual_clock(speedup)
+        self.random = np.random.RandomState(seed)
+
+        # Each parameter moves from its start towards its target from the time it was set
+        self.mapping = list(model.mach_mapping)
+        self.targets = np.array(model.mach_setting, dtype=float)
+        self.starts = self.targets.copy()
+        self.set_times = np.zeros(len(self.mapping))
+        settle_times = settle_times or {}
+        self.settle_times = np.array([settle_times.get(pv, SETTLE_TIME) for pv in self.mapping])
+
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.noise = noise
+        self.noise_correlation = noise_correlation
+        # pv -> (time, state) of its correlated noise
+        self.noise_states = {}
+
+        self.drift_rate = drift / math.sqrt(3600.)
+        self.drift = np.zeros(len(self.mapping))
+        self.drift_time = 0.
+
+        self.beam_loss_interval = beam_loss_interval
+        self.beam_loss_duration = beam_loss_duration
+        self.beam_lost_until = -1.
+        self.beam_losses = 0
+        self.next_beam_loss = self.next_loss_after(0.)
+
+        # (virtual time, ARs) of every evaluation
+        self.history = []
+
+    def next_loss_after(self, t):
+        if not self.beam_loss_interval:
+            return float('inf')
+        return t + self.random.exponential(self.beam_loss_interval)
+
+    def latency(self):
+        return self.latency_median * math.exp(self.latency_sigma * self.random.standard_normal())
+
+    def actual(self, t):
+        decay = np.exp(-(t - self.set_times) / self.settle_times)
+        return self.targets + (self.starts - self.targets) * decay
+
+    def advance(self, t):
+        """
+        Bring the drift and beam losses up to time t, which must not go backwards
+        """
+        if t > self.drift_time:
+            steps = self.random.standard_normal(len(self.drift))
+            self.drift += self.drift_rate * math.sqrt(t - self.drift_time) * steps
+            self.drift_time = t
+
+        while self.next_beam_loss <= t:
+            self.beam_losses += 1
+            self.beam_lost_until = self.next_beam_loss + self.beam_loss_duration
+            self.next_beam_loss = self.next_loss_after(self.beam_lost_until)
+
+    def sample(self, pv, t):
+        self.advance(t)
+        if t < self.beam_lost_until:
+            return float('nan')
+
+        value = model.true_value(pv, (self.actual(t) + self.drift).tolist())
+
+        # Ornstein-Uhlenbeck noise, so that samples close together in time are correlated
+        last_time, state = self.noise_states.get(pv, (t, self.random.standard_normal()))
+        rho = math.exp(-(t - last_time) / self.noise_correlation)
+        state = rho * state + math.sqrt(1 - rho ** 2) * self.random.standard_normal()
+        self.noise_states[pv] = (t, state)
+
+        return value * (1 + self.noise * state)
+
+    def put(self, pvs, values):
+        t = self.clock.time
+        actual = self.actual(t)
+        for pv, value in zip(pvs, values):
+            i = self.mapping.index(pv)
+            self.starts[i] = actual[i]
+            self.targets[i] = value
+            self.set_times[i] = t
+        self.clock.sleep(self.latency())
+
+    def get(self, pvs):
+        self.clock.sleep(self.latency())
+        values = []
+        for pv in pvs:
+            if pv in self.mapping:
+                values.append(self.targets[self.mapping.index(pv)])
+            else:
+                self.advance(self.clock.time)
+                values.append(self.sample(pv, self.clock.time))
+        return values
+
+    def wait_for_beam(self):
+        self.clock.sleep(self.beam_lost_until - self.clock.time)
+
+    def settle_time(self, pv, tolerance):
+        """
+        Time from now until the parameter pv is within tolerance of its setting
+        """
+        i = self.mapping.index(pv)
+        distance = abs(self.actual(self.clock.time)[i] - self.targets[i])
+        if distance <= tolerance:
+            return 0.
+        return self.settle_times[i] * math.log(distance / max(tolerance, 1e-12))
+
+    def set_params(self, param_vars, values):
+        """
+        Set the parameters and wait for them as set_params would: until the readbacks are in
+        tolerance but for no longer than their delays, or otherwise for the longest delay
+        """
+        if not param_vars:
+            return
+        self.put([param.pv for param in param_vars], values)
+
+        wait = 0.
+        for param in param_vars:
+            if param.readback_pv and param.tolerance is not None:
+                wait = max(wait, min(self.settle_time(param.pv, param.tolerance) + self.latency(),
+                                     param.delay))
+            else:
+                wait = max(wait, param.delay)
+        self.clock.sleep(wait)
+
+    def measure(self, measurement_vars):
+        """
+        Sample every objective, delay apart, until util.enough_samples is satisfied (as
+        util.sample_measurement_var would), with the objectives sampled concurrently. Returns the
+        samples of each objective. An objective stops at a sample taken while the beam was lost.
+        """
+        start = self.clock.time
+        samples = [[] for measurement_var in measurement_vars]
+        statistics = [util.running_statistics() for measurement_var in measurement_vars]
+
+        # Samples are taken in time order, as the drift and noise only move forwards
+        due = [(start + self.latency(), j) for j in range(len(measurement_vars))]
+        heapq.heapify(due)
+        end = start
+        while due:
+            t, j = heapq.heappop(due)
+            value = self.sample(measurement_vars[j].pv, t)
+            samples[j].append(value)
+            end = max(end, t)
+            if math.isnan(value):
+                continue
+            statistics[j].add(value)
+            if not util.enough_samples(measurement_vars[j], statistics[j]):
+                heapq.heappush(due, (t + measurement_vars[j].delay + self.latency(), j))
+
+        self.clock.sleep(end - start)
+        return samples
+
+    def record(self, ars):
+        self.history.append((self.clock.time, [ar.mean for ar in ars]))
+
+    def evaluations_per_hour(self):
+        if not self.clock.time:
+            return 0.
+        return len(self.history) * 3600. / self.clock.time
+
+    def time_to_target(self, target):
+        """
+        Virtual time of the first evaluation whose ARs are all at least as good (as small) as
+        target, or None if there was none
+        """
+        for t, ars in self.history:
+            if all(ar <= goal for ar, goal in zip(ars, target)):
+                return t
+        return None
+
+    def efficiency_report(self):
+        failed = len([ars for t, ars in self.history if any(math.isinf(ar) for ar in ars)])
+        return ('{0} evaluations in {1:.2f} virtual hours ({2:.1f} per hour), '
+                '{3} failed, {4} beam losses').format(
+                    len(self.history), self.clock.time / 3600., self.evaluations_per_hour(),
+                    failed, self.beam_losses)
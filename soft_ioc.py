@@ -0,0 +1,159 @@
+'''
+Local soft IOC standing in for the machine, so that launch.py -m can be run end to end off the
+machine. It serves the parameter PVs of model.mach_mapping (with :RBV readbacks that settle
+towards their settings), measurement PVs computed from the test problems of model.py, the DCCT
+and the injection timing PVs, all over channel access on localhost.
+
+Requires pcaspy (pip install pcaspy), which is not needed by the optimiser itself.
+
+Usage:
+    $ python soft_ioc.py [--dimensions N] [--objectives kur1,kur2] [--settle 1.0]
+
+and in another shell:
+    $ export EPICS_CA_ADDR_LIST=127.0.0.1 EPICS_CA_AUTO_ADDR_LIST=NO
+    $ python launch.py -m
+'''
+from __future__ import division
+import argparse
+import math
+import os
+import random
+import time
+
+try:
+    from pcaspy import Driver, SimpleServer
+except ImportError:
+    raise SystemExit('soft_ioc.py needs pcaspy: pip install pcaspy')
+
+from dlsoo import model, pv_names
+
+
+# Interval (s) at which the readbacks, measurements and beam current are updated
+UPDATE_PERIOD = 0.1
+# Time constant (s) with which a readback approaches its setting
+SETTLE_TIME = 1.0
+# Measurement PVs served by default
+OBJECTIVES = ['kur1', 'kur2']
+# Stored beam current (mA) at start up, its lifetime (s) and the rate (mA/s) it rises at while
+# injecting
+BEAM_CURRENT = 300.
+BEAM_LIFETIME = 20 * 3600.
+INJECTION_RATE = 5.
+# Noise (mA) on the DCCT
+BEAM_CURRENT_NOISE = 0.001
+
+
+class soft_ioc_driver(Driver):
+    """
+    Serves the PVs of the stand-in machine. Parameters are written by the optimiser; everything
+    else is updated every UPDATE_PERIOD.
+    """
+
+    def __init__(self, objectives, settle_time):
+        Driver.__init__(self)
+        self.objectives = objectives
+        self.settle_time = settle_time
+        # Where each parameter actually is, settling towards model.mach_setting
+        self.actual = list(model.mach_setting)
+        self.beam_current = BEAM_CURRENT
+        self.injecting = False
+        self.last_update = time.time()
+
+        for pv, value in zip(model.mach_mapping, model.mach_setting):
+            self.setParam(pv, value)
+            self.setParam(readback(pv), value)
+        self.setParam(pv_names.INJECTION_START_PV, 0)
+        self.setParam(pv_names.INJECTION_STOP_PV, 0)
+        self.update()
+
+    def write(self, reason, value):
+        if reason in model.mach_mapping:
+            model.caput(reason, value)
+        elif reason == pv_names.INJECTION_START_PV:
+            # The timing system starts on the rising edge of the pulse written by the interactor
+            if value:
+                self.injecting = True
+                print 'Injection started'
+        elif reason == pv_names.INJECTION_STOP_PV:
+            if value:
+                self.injecting = False
+                print 'Injection stopped'
+        else:
+            # Readbacks, measurements and the DCCT are read only
+            return False
+        self.setParam(reason, value)
+        self.updatePVs()
+        return True
+
+    def update(self):
+        now = time.time()
+        dt = now - self.last_update
+        self.last_update = now
+
+        decay = math.exp(-dt / self.settle_time) if self.settle_time else 0.
+        for i, pv in enumerate(model.mach_mapping):
+            self.actual[i] = model.mach_setting[i] + (self.actual[i] - model.mach_setting[i]) * decay
+            self.setParam(readback(pv), self.actual[i])
+
+        # Measurements are of the parameters as they actually are, so a reading taken before
+        # the readbacks have settled is of the old setting
+        for pv in self.objectives:
+            self.setParam(pv, model.measure(pv, self.actual))
+
+        if self.injecting:
+            self.beam_current += INJECTION_RATE * dt
+        else:
+            self.beam_current *= math.exp(-dt / BEAM_LIFETIME)
+        self.setParam(pv_names.BEAM_CURRENT_PV,
+                      self.beam_current + random.gauss(0, BEAM_CURRENT_NOISE))
+
+        self.updatePVs()
+
+
+def readback(pv):
+    return '{0}:RBV'.format(pv)
+
+
+def pv_database(objectives):
+    """
+    The pcaspy database of every PV served
+    """
+    pvdb = {}
+    for pv in model.mach_mapping:
+        pvdb[pv] = {'prec': 4}
+        pvdb[readback(pv)] = {'prec': 4}
+    for pv in objectives:
+        pvdb[pv] = {'prec': 6}
+    pvdb[pv_names.BEAM_CURRENT_PV] = {'prec': 4, 'unit': 'mA'}
+    pvdb[pv_names.INJECTION_START_PV] = {'type': 'int'}
+    pvdb[pv_names.INJECTION_STOP_PV] = {'type': 'int'}
+    return pvdb
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Soft IOC standing in for the machine')
+    parser.add_argument('--dimensions', type=int, default=None,
+                        help='number of parameters (default {0})'.format(len(model.mach_mapping)))
+    parser.add_argument('--objectives', default=','.join(OBJECTIVES),
+                        help='comma separated measurement PVs, any that model.true_value knows')
+    parser.add_argument('--settle', type=float, default=SETTLE_TIME,
+                        help='readback settle time constant (s)')
+    args = parser.parse_args()
+
+    if args.dimensions is not None:
+        model.resize(args.dimensions)
+    objectives = [pv.strip() for pv in args.objectives.split(',') if pv.strip()]
+
+    # Serve on localhost only, so the stand-in cannot be mistaken for the machine
+    os.environ.setdefault('EPICS_CAS_INTF_ADDR_LIST', '127.0.0.1')
+
+    server = SimpleServer()
+    server.createPV('', pv_database(objectives))
+    driver = soft_ioc_driver(objectives, args.settle)
+
+    print 'Serving parameters {0}, objectives {1}, {2}, {3} and {4}'.format(
+        ', '.join(model.mach_mapping), ', '.join(objectives), pv_names.BEAM_CURRENT_PV,
+        pv_names.INJECTION_START_PV, pv_names.INJECTION_STOP_PV)
+    while True:
+        server.process(UPDATE_PERIOD)
+        driver.update()